@@ -2,12 +2,29 @@
 #copyright notices and license terms.
 
 from trytond.pool import Pool
+from . import bom
+from . import farm
 from . import feed_production
+from . import location
+from . import product
+from . import uom
 
 
 def register():
     Pool.register(
+        bom.BOM,
+        farm.SpecieFarmLine,
+        product.Template,
+        product.Product,
+        product.ProductCostPrice,
+        uom.Uom,
+        location.Location,
+        feed_production.SupplyRequest,
         feed_production.SupplyRequestLine,
+        feed_production.SupplyRequestForecastStart,
         feed_production.Production,
         feed_production.Prescription,
         module='farm_feed_production', type_='model')
+    Pool.register(
+        feed_production.SupplyRequestForecast,
+        module='farm_feed_production', type_='wizard')
@@ -0,0 +1,77 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import Index
+from trytond.pool import PoolMeta
+
+from .cache import TransactionCache
+
+__all__ = ['BOM']
+
+
+class BOM(metaclass=PoolMeta):
+    __name__ = 'production.bom'
+    _current_version_cache = TransactionCache(
+        'production.bom.get_current_versions')
+
+    @classmethod
+    def __setup__(cls):
+        super(BOM, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.master_bom, Index.Range())))
+
+    @classmethod
+    def get_current_versions(cls, master_boms):
+        '''
+        Returns a dictionary with the current version of each master BOM (or
+        None if it hasn't any version) keyed by master BOM id.
+        The current version is the active one with the highest version
+        number (and then the latest created).
+        The versions are kept for the transaction and the master BOMs not
+        kept yet are resolved with a single query.
+        '''
+        version_ids = {}
+        missing = set()
+        for master_bom in master_boms:
+            master_id = int(master_bom)
+            version_id = cls._current_version_cache.get(master_id, -1)
+            if version_id == -1:
+                missing.add(master_id)
+            else:
+                version_ids[master_id] = version_id
+        if missing:
+            found = {}
+            for bom in cls.search([
+                        ('master_bom', 'in', list(missing)),
+                        ], order=[('version', 'DESC'), ('id', 'DESC')]):
+                found.setdefault(bom.master_bom.id, bom.id)
+            for master_id in missing:
+                version_ids[master_id] = found.get(master_id)
+                cls._current_version_cache.set(master_id,
+                    version_ids[master_id])
+        return {m: cls(v) if v is not None else None
+            for m, v in version_ids.items()}
+
+    @staticmethod
+    def _master_ids(boms):
+        'Returns the ids of the master BOMs of the BOMs'
+        return {b.master_bom.id if b.master_bom else b.id for b in boms}
+
+    @classmethod
+    def create(cls, vlist):
+        boms = super(BOM, cls).create(vlist)
+        cls._current_version_cache.delete(cls._master_ids(boms))
+        return boms
+
+    @classmethod
+    def write(cls, *args):
+        bom_ids = [b.id for boms in args[::2] for b in boms]
+        masters = cls._master_ids(cls.browse(bom_ids))
+        super(BOM, cls).write(*args)
+        masters |= cls._master_ids(cls.browse(bom_ids))
+        cls._current_version_cache.delete(masters)
+
+    @classmethod
+    def delete(cls, boms):
+        masters = cls._master_ids(boms)
+        super(BOM, cls).delete(boms)
+        cls._current_version_cache.delete(masters)
@@ -0,0 +1,39 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from weakref import WeakKeyDictionary
+
+from trytond.transaction import Transaction
+
+__all__ = ['TransactionCache']
+
+
+class TransactionCache(object):
+    '''
+    Cache of values kept only for the transaction which sets them.
+    The values are never shared with other transactions, so they don't
+    depend on the changes of other transactions or processes, and the changes
+    of the transaction are seen as soon as the affected keys are deleted.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self._caches = WeakKeyDictionary()
+
+    def _get_cache(self):
+        return self._caches.setdefault(Transaction(), {})
+
+    def get(self, key, default=None):
+        return self._get_cache().get(key, default)
+
+    def set(self, key, value):
+        self._get_cache()[key] = value
+
+    def delete(self, keys):
+        'Delete the keys from the cache of the transaction'
+        cache = self._get_cache()
+        for key in keys:
+            cache.pop(key, None)
+
+    def clear(self):
+        'Clear the cache of the transaction'
+        self._get_cache().clear()
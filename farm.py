@@ -0,0 +1,58 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+from .cache import TransactionCache
+
+__all__ = ['SpecieFarmLine']
+
+
+class SpecieFarmLine(metaclass=PoolMeta):
+    __name__ = 'farm.specie.farm_line'
+    _farm_line_cache = TransactionCache(
+        'farm.specie.farm_line.get_farm_lines')
+
+    @classmethod
+    def get_farm_lines(cls, farms):
+        '''
+        Returns a dictionary with the specie farm line of each farm (or None
+        if the farm isn't configured for any specie) keyed by farm id.
+        The lines are kept for the transaction and the farms not kept yet are
+        looked up with a single query.
+        '''
+        line_ids = {}
+        missing = set()
+        for farm in farms:
+            farm_id = int(farm)
+            line_id = cls._farm_line_cache.get(farm_id, -1)
+            if line_id == -1:
+                missing.add(farm_id)
+            else:
+                line_ids[farm_id] = line_id
+        if missing:
+            found = {}
+            for line in cls.search([
+                        ('farm', 'in', list(missing)),
+                        ]):
+                found.setdefault(line.farm.id, line.id)
+            for farm_id in missing:
+                line_ids[farm_id] = found.get(farm_id)
+                cls._farm_line_cache.set(farm_id, line_ids[farm_id])
+        return {f: cls(l) if l is not None else None
+            for f, l in line_ids.items()}
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(SpecieFarmLine, cls).create(vlist)
+        cls._farm_line_cache.clear()
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        super(SpecieFarmLine, cls).write(*args)
+        cls._farm_line_cache.clear()
+
+    @classmethod
+    def delete(cls, lines):
+        super(SpecieFarmLine, cls).delete(lines)
+        cls._farm_line_cache.clear()
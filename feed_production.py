@@ -1,12 +1,35 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime
+import json
+import logging
+import os
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from datetime import timedelta
 from decimal import Decimal
 
-from trytond.model import ModelView, Workflow, fields
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sql import Null
+from sql.aggregate import Min
+from sql.operators import Like
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import Index, Model, ModelView, Workflow, fields
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Bool, Eval, Or
-from trytond.transaction import Transaction
+from trytond.pyson import Bool, Eval, Or, PYSONEncoder
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction, TransactionError
+from trytond.wizard import Button, StateAction, StateView, Wizard
 from trytond.exceptions import UserError
 from trytond.model.exceptions import ValidationError
 from trytond.i18n import gettext
@@ -14,57 +37,535 @@ from trytond.modules.production_supply_request.supply_request \
     import prepare_write_vals
 from trytond.modules.product import round_price
 
-__all__ = ['Prescription', 'Production', 'SupplyRequestLine']
+from .instrumentation import instrumented, count_write_records
+
+__all__ = ['Prescription', 'Production', 'SupplyRequest',
+    'SupplyRequestLine', 'SupplyRequestForecastStart',
+    'SupplyRequestForecast']
+
+logger = logging.getLogger(__name__)
+
+
+def queue_prescriptions():
+    '''
+    Returns if the prescriptions of the confirmed supply requests must be
+    generated by the queue instead of during the confirmation
+    '''
+    return bool(Transaction().context.get('queue_prescriptions',
+            config.getboolean('farm_feed_production', 'queue_prescriptions',
+                default=False)))
+
+
+def merge_productions():
+    '''
+    Returns if the compatible productions of the confirmed supply requests
+    must be merged into batches
+    '''
+    return bool(Transaction().context.get('merge_productions',
+            config.getboolean('farm_feed_production', 'merge_productions',
+                default=False)))
+
+
+def _carry_over(drugs, next_drugs):
+    'Returns the drugs carried over by a batch to the next one'
+    if drugs is None or next_drugs is None:
+        return 0
+    return len(drugs - next_drugs)
+
+
+def carry_over_order(drug_sets, max_passes=20):
+    '''
+    Returns the order (list of indexes) of the batches which drugs are in
+    drug_sets that reduces the drugs carried over between consecutive
+    batches, that is the flushes needed.
+    It starts from a greedy sequence, which always continues with the batch
+    with lower carry over (and then fewer drugs), and improves it moving each
+    batch to its best position until there is no improvement.
+    '''
+    if len(drug_sets) < 3:
+        return sorted(range(len(drug_sets)), key=lambda i: len(drug_sets[i]))
+    remaining = set(range(len(drug_sets)))
+    current = min(remaining, key=lambda i: (len(drug_sets[i]), i))
+    order = [current]
+    remaining.remove(current)
+    while remaining:
+        current = min(remaining, key=lambda i: (
+                _carry_over(drug_sets[current], drug_sets[i]),
+                len(drug_sets[i]), i))
+        order.append(current)
+        remaining.remove(current)
+
+    def cost(a, b):
+        return _carry_over(drug_sets[a] if a is not None else None,
+            drug_sets[b] if b is not None else None)
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(len(order)):
+            item = order[i]
+            before = order[i - 1] if i > 0 else None
+            after = order[i + 1] if i + 1 < len(order) else None
+            gain = (cost(before, item) + cost(item, after)
+                - cost(before, after))
+            if gain <= 0:
+                continue
+            rest = order[:i] + order[i + 1:]
+            best, best_position = 0, None
+            for position in range(len(rest) + 1):
+                before = rest[position - 1] if position > 0 else None
+                after = rest[position] if position < len(rest) else None
+                delta = (gain + cost(before, after) - cost(before, item)
+                    - cost(item, after))
+                if delta > best:
+                    best, best_position = delta, position
+            if best_position is not None:
+                rest.insert(best_position, item)
+                order = rest
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+class SupplyRequest(metaclass=PoolMeta):
+    __name__ = 'stock.supply_request'
+
+    prescriptions_pending = fields.Function(fields.Boolean(
+            'Prescriptions Pending'), 'get_prescriptions_pending')
+
+    @classmethod
+    def get_prescriptions_pending(cls, requests, name):
+        return {r.id: any(l.prescription_pending for l in r.lines)
+            for r in requests}
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('confirmed')
+    @instrumented('stock.supply_request.confirm')
+    def confirm(cls, requests):
+        pool = Pool()
+        SupplyRequestLine = pool.get('stock.supply_request.line')
+        Bom = pool.get('production.bom')
+        Product = pool.get('product.product')
+        Production = pool.get('production')
+
+        lines = [l for r in requests for l in r.lines if not l.move]
+        Product.get_prescription_info({l.product for l in lines})
+        Bom.get_current_versions({pb.bom.master_bom or pb.bom
+                for l in lines for pb in l.product.boms})
+        if queue_prescriptions():
+            with Transaction().set_context(queue_prescriptions=True):
+                super(SupplyRequest, cls).confirm(requests)
+            to_generate = [l for l in lines if l.prescription_required]
+            size = config.getint('farm_feed_production',
+                'prescription_queue_size', default=100)
+            for i in range(0, len(to_generate), size):
+                SupplyRequestLine.__queue__.generate_prescriptions(
+                    to_generate[i:i + size])
+        else:
+            prescriptions = SupplyRequestLine.create_prescriptions(lines)
+            with Transaction().set_context(
+                    supply_request_line_prescriptions={
+                        l.id: p.id for l, p in prescriptions.items()}):
+                super(SupplyRequest, cls).confirm(requests)
+        if merge_productions():
+            cls.merge_productions(lines)
+        productions = [l.production
+            for l in SupplyRequestLine.browse([l.id for l in lines])
+            if l.production]
+        if productions:
+            Production.sequence_new_productions(productions)
+
+    @classmethod
+    def merge_productions(cls, lines):
+        '''
+        Merge the compatible productions of the confirmed lines.
+        Returns the number of productions saved.
+        '''
+        pool = Pool()
+        Production = pool.get('production')
+        SupplyRequestLine = pool.get('stock.supply_request.line')
+
+        lines = SupplyRequestLine.browse([l.id for l in lines])
+        saved = Production.merge([l.production for l in lines
+                if l.production])
+        if saved:
+            logger.info('%s productions saved merging the productions of '
+                'supply requests', saved)
+        return saved
+
+    @classmethod
+    def confirm_by_warehouse(cls, requests, workers=None):
+        '''
+        Confirm the requests grouped by destination warehouse, each group in
+        its own transaction, using a pool of workers threads (by default the
+        confirm_workers option of the [farm_feed_production] configuration
+        section or the number of CPUs).
+        As the requests are confirmed in new transactions they must be
+        already committed. The groups are confirmed concurrently only if the
+        database backend supports concurrent connections (PostgreSQL), on
+        SQLite they are confirmed one after the other.
+        If a group fails, each of its requests is retried in its own
+        transaction to report only the ones which fail.
+        Returns a list of (request id, error message) of the failed requests.
+        '''
+        transaction = Transaction()
+        database_name = transaction.database.name
+        user = transaction.user
+        context = dict(transaction.context)
+
+        request_ids = defaultdict(list)
+        for request in requests:
+            request_ids[request.to_warehouse.id].append(request.id)
+        if workers is None:
+            workers = config.getint('farm_feed_production', 'confirm_workers',
+                default=os.cpu_count() or 1)
+        if backend.name == 'sqlite':
+            workers = 1
+        workers = max(1, min(workers, len(request_ids)))
+
+        def confirm(ids):
+            message = cls._confirm_transaction(database_name, user, context,
+                ids)
+            if message is None:
+                return []
+            if len(ids) == 1:
+                return [(ids[0], message)]
+            failures = []
+            for id_ in ids:
+                failures.extend(confirm([id_]))
+            return failures
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            failures = []
+            for group_failures in executor.map(confirm,
+                    request_ids.values()):
+                failures.extend(group_failures)
+        return failures
+
+    @classmethod
+    def _confirm_transaction(cls, database_name, user, context, ids):
+        '''
+        Confirm the requests in a new transaction which is committed.
+        Like the RPC dispatcher, the transaction is retried on lock errors
+        and up to the retry option of the [database] configuration section
+        on operational errors (ie: serialization failures).
+        Returns the error message if it fails or None.
+        '''
+        retry = config.getint('database', 'retry')
+        count = 0
+        transaction_extras = {}
+        while True:
+            if count:
+                time.sleep(0.02 * count)
+            with Transaction().start(database_name, user, context=context,
+                    **transaction_extras) as transaction:
+                try:
+                    cls.confirm(cls.browse(ids))
+                    transaction.commit()
+                except TransactionError as exception:
+                    transaction.rollback()
+                    exception.fix(transaction_extras)
+                    continue
+                except backend.DatabaseOperationalError as exception:
+                    transaction.rollback()
+                    if count < retry:
+                        count += 1
+                        logger.debug('Retry confirmation of supply requests '
+                            '%s: %i', ids, count)
+                        continue
+                    logger.warning('Confirmation of supply requests %s '
+                        'failed', ids, exc_info=True)
+                    return str(exception)
+                except Exception as exception:
+                    transaction.rollback()
+                    logger.warning('Confirmation of supply requests %s '
+                        'failed', ids, exc_info=True)
+                    return (getattr(exception, 'message', None)
+                        or str(exception))
+                return
+
+    @classmethod
+    @instrumented('stock.supply_request.forecast')
+    def forecast(cls, silos, product, consumption, days, date=None,
+            from_warehouse=None):
+        '''
+        Create the supply requests of product to cover the feed consumption
+        of the animals and groups fed by the silos during the next days.
+        The prescriptions of their lines get the animals fed by the silo.
+        consumption is the daily quantity per head, in the default unit of
+        the product. The stock of the silos is discounted from the demand and
+        one request is created for each destination warehouse, so all the
+        silos must be inside a warehouse.
+        Returns the list of created requests.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        SupplyRequestLine = pool.get('stock.supply_request.line')
+        StockConfiguration = pool.get('stock.configuration')
+
+        if numpy is None:
+            raise UserError(gettext(
+                    'farm_feed_production.msg_forecast_numpy_required'))
+        if date is None:
+            date = Date.today()
+        if from_warehouse is None:
+            from_warehouse = StockConfiguration(1).request_from_warehouse
+        silos = [s for s in silos if s.silo]
+        if not silos:
+            return []
+        without_warehouse = [s for s in silos if not s.warehouse]
+        if without_warehouse:
+            raise UserError(gettext('farm_feed_production.'
+                    'msg_forecast_silo_without_warehouse',
+                    silos=', '.join(s.rec_name for s in without_warehouse)))
+
+        fed_animals = Location.get_fed_animals(silos, date=date)
+        silo_ids = [s.id for s in silos]
+        with Transaction().set_context(stock_date_end=date):
+            stock = Product.products_by_location(silo_ids, with_childs=True,
+                grouping_filter=([product.id],))
+        heads = numpy.array([fed_animals[i].heads for i in silo_ids],
+            dtype=float)
+        available = numpy.array(
+            [stock.get((i, product.id), 0) for i in silo_ids], dtype=float)
+        demand = numpy.clip(heads * consumption * days - available, 0, None)
+
+        company = Transaction().context.get('company')
+        lines = defaultdict(list)
+        for silo, quantity in zip(silos, demand.tolist()):
+            quantity = product.default_uom.round(quantity)
+            if quantity <= 0:
+                continue
+            lines[silo.warehouse].append(SupplyRequestLine(
+                    product=product,
+                    unit=product.default_uom,
+                    quantity=quantity,
+                    to_location=silo,
+                    delivery_date=date,
+                    from_forecast=True,
+                    ))
+        requests = [cls(company=company, from_warehouse=from_warehouse,
+                to_warehouse=w, lines=l) for w, l in lines.items()]
+        cls.save(requests)
+        return requests
+
+
+class SupplyRequestForecastStart(ModelView):
+    'Supply Request Forecast Start'
+    __name__ = 'stock.supply_request.forecast.start'
+
+    silos = fields.Many2Many('stock.location', None, None, 'Silos',
+        required=True, domain=[
+            ('silo', '=', True),
+            ])
+    product = fields.Many2One('product.product', 'Product', required=True)
+    consumption = fields.Float('Daily Consumption', required=True,
+        help='Quantity consumed per head and day in the default unit of the '
+        'product.')
+    days = fields.Integer('Days', required=True)
+    date = fields.Date('Date', required=True)
+    from_warehouse = fields.Many2One('stock.location', 'From Warehouse',
+        domain=[
+            ('type', '=', 'warehouse'),
+            ])
+
+    @staticmethod
+    def default_date():
+        pool = Pool()
+        Date = pool.get('ir.date')
+        return Date.today()
+
+    @staticmethod
+    def default_from_warehouse():
+        pool = Pool()
+        StockConfiguration = pool.get('stock.configuration')
+        from_warehouse = StockConfiguration(1).request_from_warehouse
+        return from_warehouse.id if from_warehouse else None
+
+
+class SupplyRequestForecast(Wizard):
+    'Supply Request Forecast'
+    __name__ = 'stock.supply_request.forecast'
+
+    start = StateView('stock.supply_request.forecast.start',
+        'farm_feed_production.supply_request_forecast_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Forecast', 'forecast', 'tryton-ok', default=True),
+            ])
+    forecast = StateAction(
+        'farm_feed_production.act_supply_request_forecast')
+
+    def do_forecast(self, action):
+        pool = Pool()
+        SupplyRequest = pool.get('stock.supply_request')
+
+        requests = SupplyRequest.forecast(self.start.silos, self.start.product,
+            self.start.consumption, self.start.days, date=self.start.date,
+            from_warehouse=self.start.from_warehouse)
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('id', 'in', [r.id for r in requests]),
+                ])
+        return action, {}
 
 
 class SupplyRequestLine(metaclass=PoolMeta):
     __name__ = 'stock.supply_request.line'
 
+    merged_production = fields.Many2One('production', 'Merged Production',
+        readonly=True, ondelete='SET NULL')
+    from_forecast = fields.Boolean('From Forecast', readonly=True)
+
+    @staticmethod
+    def default_from_forecast():
+        return False
+
+    @classmethod
+    def __setup__(cls):
+        super(SupplyRequestLine, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.merged_production, Index.Range())))
+
+    @instrumented('stock.supply_request.line.get_move')
     def get_move(self):
         pool = Pool()
         Prescription = pool.get('farm.prescription')
 
         move = super(SupplyRequestLine, self).get_move()
-        if self.product.prescription_required:
-            with Transaction().set_user(0, set_context=True):
-                prescription = self.get_prescription()
-                prescription.save()
-                if prescription.template:
-                    Prescription.set_template([prescription])
+        if self.prescription_required:
+            prescription_id = Transaction().context.get(
+                'supply_request_line_prescriptions', {}).get(self.id)
+            if prescription_id is not None:
+                prescription = Prescription(prescription_id)
+            elif Transaction().context.get('queue_prescriptions'):
+                # The prescription will be generated by the queue
+                return move
+            else:
+                prescription, = self.create_prescriptions([self]).values()
             move.prescription = prescription
             move.quantity += prescription.drug_quantity
         return move
 
+    @property
+    def prescription_required(self):
+        pool = Pool()
+        Product = pool.get('product.product')
+        return Product.get_prescription_info([self.product])[
+            self.product.id].required
+
+    @property
+    def prescription_pending(self):
+        'The line requires a prescription that has not been generated yet'
+        return bool(self.prescription_required and self.move
+            and not self.move.prescription)
+
+    @classmethod
+    @instrumented('stock.supply_request.line.generate_prescriptions')
+    def generate_prescriptions(cls, lines):
+        '''
+        Generate the pending prescriptions of the lines of confirmed supply
+        requests and set them to their move and production.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+
+        lines = [l for l in lines if l.prescription_pending]
+        prescriptions = cls.create_prescriptions(lines)
+        if not prescriptions:
+            return
+        to_write = []
+        for line, prescription in prescriptions.items():
+            to_write.extend(([line.move], {
+                        'prescription': prescription.id,
+                        'quantity': (line.move.quantity
+                            + prescription.drug_quantity),
+                        }))
+        Move.write(*to_write)
+        to_write = []
+        for line, prescription in prescriptions.items():
+            production = line.production
+            if production:
+                production.prescription = prescription
+                changes = production.explode_bom()
+                values = prepare_write_vals(changes) if changes else {}
+                values['prescription'] = prescription.id
+                to_write.extend(([production], values))
+        if to_write:
+            Production.write(*to_write)
+
+    @classmethod
+    @instrumented('stock.supply_request.line.create_prescriptions')
+    def create_prescriptions(cls, lines):
+        '''
+        Create and apply the template to the prescriptions of the lines which
+        product requires it. The prescriptions of the lines created by the
+        forecast get the animals and groups fed by their silo.
+        Returns a dictionary with the created prescription of each line.
+        '''
+        pool = Pool()
+        Prescription = pool.get('farm.prescription')
+        FarmLine = pool.get('farm.specie.farm_line')
+        Product = pool.get('product.product')
+        Location = pool.get('stock.location')
+
+        Product.get_prescription_info({l.product for l in lines})
+        lines = [l for l in lines if l.prescription_required]
+        if not lines:
+            return {}
+        with Transaction().set_user(0, set_context=True):
+            FarmLine.get_farm_lines({l.request.to_warehouse for l in lines})
+            prescriptions = [l.get_prescription() for l in lines]
+            fed_animals = Location.get_fed_animals({l.to_location
+                    for l in lines if l.from_forecast and l.to_location.silo})
+            for line, prescription in zip(lines, prescriptions):
+                fed = (fed_animals.get(line.to_location.id)
+                    if line.from_forecast else None)
+                if fed:
+                    prescription.animals = [a for a in fed.animals
+                        if a.specie == prescription.specie]
+                    prescription.animal_groups = [g for g in fed.animal_groups
+                        if g.specie == prescription.specie]
+            Prescription.save(prescriptions)
+            to_template = [p for p in prescriptions if p.template]
+            if to_template:
+                Prescription.set_template(to_template)
+        return dict(zip(lines, prescriptions))
+
+    @instrumented('stock.supply_request.line.get_prescription')
     def get_prescription(self):
         pool = Pool()
         Date = pool.get('ir.date')
         FarmLine = pool.get('farm.specie.farm_line')
+        Product = pool.get('product.product')
 
-        farm_lines = FarmLine.search([
-                ('farm', '=', self.request.to_warehouse.id),
-                ])
-        if not farm_lines:
+        to_warehouse = self.request.to_warehouse
+        farm_line = FarmLine.get_farm_lines([to_warehouse])[to_warehouse.id]
+        if not farm_line:
             raise UserError(gettext('farm_feed_production.'
                     'msg_to_warehouse_farm_line_not_available',
                     request=self.request.rec_name))
 
         Prescription = pool.get('farm.prescription')
         prescription = Prescription()
-        prescription.specie = farm_lines[0].specie
+        prescription.specie = farm_line.specie
         prescription.date = Date.today()
         prescription.farm = self.request.to_warehouse
         prescription.delivery_date = self.delivery_date
         prescription.product = self.product
         prescription.quantity = self.quantity
-        # prescription.animals
-        # prescription.animal_groups
         prescription.origin = self
 
-        if self.product.prescription_template:
-            prescription.template = self.product.prescription_template
+        template = Product.get_prescription_info([self.product])[
+            self.product.id].template
+        if template is not None:
+            prescription.template = template
 
         return prescription
 
+    @instrumented('stock.supply_request.line.get_production')
     def get_production(self):
         with Transaction().set_context(
                 avoid_production_check_prescription=True):
@@ -73,22 +574,22 @@ class SupplyRequestLine(metaclass=PoolMeta):
                 production.prescription = self.move.prescription
             return production
 
+    @instrumented('stock.supply_request.line._production_bom')
     def _production_bom(self):
         pool = Pool()
         Bom = pool.get('production.bom')
 
         product_bom = super(SupplyRequestLine, self)._production_bom()
         if product_bom:
-            current_version = Bom.search([
-                    ('master_bom', '=', product_bom.master_bom),
-                    ], limit=1)
-            if current_version:
-                return current_version[0]
+            master_bom = product_bom.master_bom or product_bom
+            return (Bom.get_current_versions([master_bom])[master_bom.id]
+                or product_bom)
         return None
 
 
 class Production(metaclass=PoolMeta):
     __name__ = 'production'
+    _explode_bom_cache = Cache('production.explode_bom', context=False)
 
     prescription = fields.Many2One('farm.prescription', 'Prescription',
         domain=[
@@ -100,10 +601,22 @@ class Production(metaclass=PoolMeta):
             'invisible': ~Eval('product'),
             },
         depends=['warehouse', 'product', 'state', 'from_supply_request'])
+    merged_lines = fields.One2Many('stock.supply_request.line',
+        'merged_production', 'Merged Supply Request Lines', readonly=True)
+    sequence = fields.Integer('Sequence', readonly=True,
+        help='Order in which the production is run in its day to reduce the '
+        'drugs carried over between batches.')
 
     @classmethod
     def __setup__(cls):
         super(Production, cls).__setup__()
+        cls._buttons.update({
+                'sequence_day': {
+                    'invisible': ~Eval('state').in_(
+                        ['request', 'draft', 'waiting', 'assigned']),
+                    'depends': ['state'],
+                    },
+                })
         for fname in ('product', 'bom', 'unit', 'quantity'):
             field = getattr(cls, fname)
             for fname2 in ('prescription', 'origin'):
@@ -111,54 +624,102 @@ class Production(metaclass=PoolMeta):
 
     @fields.depends(methods=['explode_bom'])
     def on_change_prescription(self):
-        self.explode_bom()
+        with Transaction().set_context(explode_bom_incremental=True):
+            self.explode_bom()
+
+    @fields.depends(methods=['explode_bom'])
+    def on_change_quantity(self):
+        with Transaction().set_context(explode_bom_incremental=True):
+            return super(Production, self).on_change_quantity()
 
     @classmethod
     def validate(cls, productions):
         super(Production, cls).validate(productions)
-        for production in productions:
-            production.check_prescription()
+        cls.check_prescriptions(productions)
 
     def check_prescription(self):
+        self.check_prescriptions([self])
+
+    @classmethod
+    @instrumented('production.check_prescriptions')
+    def check_prescriptions(cls, productions):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        PrescriptionLine = pool.get('farm.prescription.line')
+        cursor = Transaction().connection.cursor()
+        move = Move.__table__()
+        prescription_line = PrescriptionLine.__table__()
+
         if Transaction().context.get('avoid_production_check_prescription'):
             return
 
-        if self.from_supply_request and (
-                self.origin.product.prescription_required and
-                not self.prescription or
-                self.prescription != self.origin.move.prescription):
-            raise ValidationError(gettext('farm_feed_production.'
-                    'msg_from_supply_request_invalid_prescription',
-                    production=self.rec_name,
-                    origin=self.origin.request.rec_name,
-                    ))
-        if not self.prescription:
+        for production in productions:
+            if (production.from_supply_request
+                    and not production.origin.prescription_pending
+                    and (production.origin.prescription_required
+                        and not production.prescription
+                        or production.prescription !=
+                        production.origin.move.prescription)):
+                raise ValidationError(gettext('farm_feed_production.'
+                        'msg_from_supply_request_invalid_prescription',
+                        production=production.rec_name,
+                        origin=production.origin.request.rec_name,
+                        ))
+        productions = {p.id: p for p in productions if p.prescription}
+        if not productions:
             return
 
-        prescription_lines = list(self.prescription.lines[:])
-        for input_move in self.inputs:
-            if (input_move.prescription and
-                    input_move.prescription != self.prescription):
+        # Multisets (by id) of the lines of each prescription and of the
+        # prescription lines used as origin of the inputs of each production
+        prescription_lines = defaultdict(Counter)
+        prescription_ids = list({p.prescription.id
+                for p in productions.values()})
+        for sub_ids in grouped_slice(prescription_ids):
+            cursor.execute(*prescription_line.select(
+                    prescription_line.prescription, prescription_line.id,
+                    where=reduce_ids(prescription_line.prescription,
+                        sub_ids)))
+            for prescription_id, line_id in cursor:
+                prescription_lines[prescription_id][line_id] += 1
+
+        input_lines = defaultdict(Counter)
+        line_prefix = '%s,' % PrescriptionLine.__name__
+        for sub_ids in grouped_slice(list(productions.keys())):
+            cursor.execute(*move.select(move.id, move.production_input,
+                    move.prescription, move.origin,
+                    where=reduce_ids(move.production_input, sub_ids)
+                    & (move.prescription != Null)))
+            for move_id, production_id, prescription_id, origin in cursor:
+                production = productions[production_id]
+                if prescription_id != production.prescription.id:
+                    raise ValidationError(gettext('farm_feed_production.'
+                            'msg_invalid_input_move_prescription',
+                            move=Move(move_id).rec_name,
+                            production=production.rec_name,
+                            ))
+                if origin and origin.startswith(line_prefix):
+                    line_id = int(origin[len(line_prefix):])
+                    input_lines[production_id][line_id] += 1
+
+        for production_id, production in productions.items():
+            missing = (prescription_lines[production.prescription.id]
+                - input_lines[production_id])
+            if missing:
                 raise ValidationError(gettext('farm_feed_production.'
-                        'msg_invalid_input_move_prescription',
-                        move=input_move.rec_name,
-                        production=self.rec_name,
+                        'msg_missing_input_moves_from_prescription',
+                        production=production.rec_name,
+                        missing_lines=", ".join(l.rec_name
+                            for l in production.prescription.lines
+                            if l.id in missing),
                         ))
-            if input_move.prescription:
-                prescription_lines.remove(input_move.origin)
-        if prescription_lines:
-            raise ValidationError(gettext('farm_feed_production.'
-                    'msg_missing_input_moves_from_prescription',
-                    production=self.rec_name,
-                    missing_lines=", ".join(l.rec_name for l in
-                        prescription_lines),
-                    ))
 
+    @instrumented('production.explode_bom')
     def explode_bom(self):
         pool = Pool()
+        Product = pool.get('product.product')
         Uom = pool.get('product.uom')
 
-        changes = super(Production, self).explode_bom()
+        changes = self._explode_bom_without_prescription()
         if not changes or not self.prescription:
             return changes
         # Set the prescription to the main output move
@@ -167,7 +728,7 @@ class Production(metaclass=PoolMeta):
                 for _, output_vals in changes['outputs']['add']:
                     if output_vals.get('product') == self.product.id:
                         output_vals['prescription'] = self.prescription.id
-                        output_vals['quantity'] += Uom.compute_qty(
+                        output_vals['quantity'] += Uom.convert_qty(
                             self.prescription.unit,
                             self.prescription.drug_quantity,
                             Uom(output_vals['unit']))
@@ -180,24 +741,32 @@ class Production(metaclass=PoolMeta):
         else:
             storage_location = None
 
-        inputs = changes['inputs']
-        extra_cost = Decimal(0)
-
-        factor = self.prescription.get_factor_change_quantity_unit(
+        prescription_lines = list(self.prescription.lines)
+        Uom.get_conversion_table({u for u in [self.unit,
+                    self.prescription.unit] + [l.unit
+                    for l in prescription_lines] if u})
+        factor = self.get_prescription_factor(self.prescription,
             self.quantity, self.unit)
-        for prescription_line in self.prescription.lines:
-            if factor is not None:
+        if factor is not None:
+            for prescription_line in prescription_lines:
                 prescription_line.quantity = (
                     prescription_line.compute_quantity(factor))
-            values = self._explode_prescription_line_values(storage_location,
-                self.location, self.company, prescription_line)
-            if values:
-                inputs['add'].append((-1, values))
-                quantity = Uom.compute_qty(prescription_line.unit,
-                    prescription_line.quantity,
-                    prescription_line.product.default_uom)
-                extra_cost += (Decimal(str(quantity)) *
-                    prescription_line.product.cost_price)
+
+        lines_values = self._explode_prescription_lines_incremental(
+            storage_location, self.location, self.company, prescription_lines)
+        changes['inputs']['add'].extend((-1, v) for _, v in lines_values)
+        prescription_lines = [l for l, _ in lines_values]
+
+        quantities = [Uom.convert_qty(l.unit, l.quantity,
+                l.product.default_uom) for l in prescription_lines]
+        company = (self.company.id if self.company
+            else Transaction().context.get('company'))
+        with Transaction().set_context(company=company):
+            cost_prices = Product.get_cost_prices(
+                {l.product for l in prescription_lines})
+        extra_cost = sum((Decimal(str(quantity)) * cost_prices[l.product.id]
+                for l, quantity in zip(prescription_lines, quantities)),
+            Decimal(0))
 
         for _, output in changes['outputs']['add']:
             quantity = output.get('quantity')
@@ -208,6 +777,380 @@ class Production(metaclass=PoolMeta):
         changes['cost'] += extra_cost
         return changes
 
+    def _explode_bom_without_prescription(self):
+        '''
+        Returns the changes of the parent BOM explosion.
+        In incremental mode (explode_bom_incremental in the context) the
+        parent explosion is kept by the values it depends on but the quantity
+        (see _explode_bom_key) and the next ones with the same values are
+        scaled to the quantity with _scale_explosion. An explosion is only
+        kept if scaling it to its own quantity gives the parent's changes.
+        '''
+        if (not Transaction().context.get('explode_bom_incremental')
+                or not self.bom or not self.product or not self.unit
+                or not self.quantity):
+            return super(Production, self).explode_bom()
+
+        key = self._explode_bom_key()
+        cached = self._explode_bom_cache.get(key)
+        if cached is not None:
+            changes = deepcopy(cached)
+            if self._scale_explosion(changes):
+                return changes
+        changes = super(Production, self).explode_bom()
+        if changes:
+            scaled = deepcopy(changes)
+            if self._scale_explosion(scaled) and scaled == changes:
+                self._explode_bom_cache.set(key, deepcopy(changes))
+        return changes
+
+    @classmethod
+    def _explode_bom_key_fields(cls):
+        '''
+        Returns the names of the fields, but the quantity, the BOM explosion
+        depends on
+        '''
+        return [n for n in ['type', 'company', 'warehouse', 'location', 'bom',
+                'product', 'unit', 'state', 'planned_date',
+                'planned_start_date', 'effective_date', 'effective_start_date']
+            if n in cls._fields]
+
+    def _explode_bom_key(self):
+        '''
+        Returns the key of the kept explosion: the values of the fields it
+        depends on but the quantity, so it is shared by the productions of
+        the same BOM, product, unit, locations and dates, and the write
+        dates of the BOM and its lines, so its changes are not hidden.
+        '''
+        values = []
+        for name in self._explode_bom_key_fields():
+            value = getattr(self, name, None)
+            if isinstance(value, Model):
+                value = value.id
+            values.append(value)
+        if self.bom:
+            values.append(tuple((str(r), str(r.write_date))
+                    for r in (self.bom,) + self.bom.inputs
+                    + self.bom.outputs))
+        return tuple(values)
+
+    def _scale_explosion(self, changes):
+        '''
+        Set to the changes of a kept explosion the quantities of the BOM lines
+        for the factor of the production's quantity, their cost and the
+        current moves to remove.
+        Returns False if the moves of the changes don't match the BOM lines.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        bom = self.bom
+        inputs = changes.get('inputs', {}).get('add', [])
+        outputs = changes.get('outputs', {}).get('add', [])
+        if ([v.get('product') for _, v in inputs]
+                != [i.product.id for i in bom.inputs]
+                or [v.get('product') for _, v in outputs]
+                != [o.product.id for o in bom.outputs]):
+            return False
+
+        factor = bom.compute_factor(self.product, self.quantity, self.unit)
+        Uom.get_conversion_table({u for i in bom.inputs
+                for u in (i.unit, i.product.default_uom)})
+        company = (self.company.id if self.company
+            else Transaction().context.get('company'))
+        with Transaction().set_context(company=company):
+            cost_prices = Product.get_cost_prices(
+                {i.product for i in bom.inputs})
+        cost = Decimal(0)
+        for (_, values), input_ in zip(inputs, bom.inputs):
+            quantity = input_.compute_quantity(factor)
+            values['quantity'] = quantity
+            cost += (Decimal(str(Uom.convert_qty(input_.unit, quantity,
+                            input_.product.default_uom)))
+                * cost_prices[input_.product.id])
+        for (_, values), output in zip(outputs, bom.outputs):
+            quantity = output.compute_quantity(factor)
+            values['quantity'] = quantity
+            if values.get('unit_price') is not None:
+                values['unit_price'] = (round_price(
+                        cost / Decimal(str(quantity)))
+                    if quantity else Decimal(0))
+        if 'cost' in changes:
+            changes['cost'] = cost
+        for name in ('inputs', 'outputs'):
+            if 'remove' in changes.get(name, {}):
+                changes[name]['remove'] = [m.id
+                    for m in getattr(self, name) or []]
+        return True
+
+    def _explode_prescription_lines_incremental(self, from_location,
+            to_location, company, lines):
+        '''
+        Returns _explode_prescription_lines_values of the prescription lines.
+        In incremental mode the values of the lines of a stored prescription
+        are kept by the explosion key and the prescription and lines write
+        dates, and the next ones only get the quantity of each line.
+        '''
+        prescription = self.prescription
+        if (not Transaction().context.get('explode_bom_incremental')
+                or prescription.id is None or prescription.id < 0
+                or any(l.id is None or l.id < 0 for l in lines)):
+            return self._explode_prescription_lines_values(from_location,
+                to_location, company, lines)
+
+        key = ('prescription', self._explode_bom_key(),
+            from_location.id if from_location else None,
+            to_location.id if to_location else None,
+            company.id if company else None,
+            prescription.id, str(prescription.write_date),
+            tuple((l.id, str(l.write_date)) for l in lines))
+        cached = self._explode_bom_cache.get(key)
+        if cached is None:
+            lines_values = self._explode_prescription_lines_values(
+                from_location, to_location, company, lines)
+            self._explode_bom_cache.set(key, deepcopy(
+                    [(l.id, v) for l, v in lines_values]))
+            return lines_values
+        lines = {l.id: l for l in lines}
+        lines_values = []
+        for line_id, values in deepcopy(cached):
+            line = lines[line_id]
+            values['quantity'] = line.quantity
+            lines_values.append((line, values))
+        return lines_values
+
+    @staticmethod
+    def get_prescription_factor(prescription, quantity, unit):
+        '''
+        Returns the factor to apply to the prescription to change it to the
+        quantity and unit or None if they are the same, like
+        Prescription.get_factor_change_quantity_unit but using the unit
+        conversion table.
+        '''
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        quantity = Uom.convert_qty(unit, quantity, prescription.unit)
+        if quantity != prescription.quantity and prescription.quantity:
+            return quantity / prescription.quantity
+
+    @classmethod
+    def explode_boms(cls, productions):
+        '''
+        Explode the BOM of the productions and write the changes.
+        The productions are browsed together, the cost prices of their drugs
+        are loaded at once and the changes are written with a single write.
+        The BOM is exploded in incremental mode, so the parent explode_bom
+        runs once for each BOM, product, unit, locations and dates and its
+        result is scaled to the quantity of the rest of productions.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        productions = cls.browse([p.id for p in productions])
+        drugs = defaultdict(set)
+        for production in productions:
+            if production.prescription and production.company:
+                drugs[production.company.id].update(l.product
+                    for l in production.prescription.lines)
+        for company_id, products in drugs.items():
+            with Transaction().set_context(company=company_id):
+                Product.get_cost_prices(products)
+        to_write = []
+        with Transaction().set_context(explode_bom_incremental=True):
+            for production in productions:
+                changes = production.explode_bom()
+                if changes:
+                    to_write.extend(
+                        ([production], prepare_write_vals(changes)))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    @instrumented('production.merge')
+    def merge(cls, productions):
+        '''
+        Merge into batches the productions of supply request lines without
+        prescription which share product, BOM, warehouse and locations.
+        A batch includes the productions planned within the merge_window
+        days of the first one and up to the mixer_capacity (in the default
+        unit of the product, unlimited if not set). Both are taken from the
+        context or else from the options of the [farm_feed_production]
+        configuration section.
+        The first production of each batch gets the quantity of the batch
+        and the rest are deleted. All the lines of the batch are linked to
+        it as their production and merged production.
+        Returns the number of deleted productions.
+        '''
+        pool = Pool()
+        SupplyRequestLine = pool.get('stock.supply_request.line')
+        Uom = pool.get('product.uom')
+
+        context = Transaction().context
+        window = timedelta(days=context.get('merge_window',
+                config.getint('farm_feed_production', 'merge_window',
+                    default=0)))
+        capacity = context.get('mixer_capacity',
+            config.getfloat('farm_feed_production', 'mixer_capacity',
+                default=0))
+
+        groups = defaultdict(list)
+        for production in productions:
+            if (production.state not in ('request', 'draft')
+                    or production.prescription
+                    or not production.from_supply_request
+                    or production.origin.prescription_required):
+                continue
+            groups[(production.company, production.warehouse,
+                    production.location, production.product,
+                    production.bom)].append(production)
+        Uom.get_conversion_table({u for p in productions
+                for u in (p.unit, p.product.default_uom)})
+
+        batches = []
+        for group in groups.values():
+            group.sort(key=lambda p: (p.planned_date or datetime.date.max,
+                    p.id))
+            batch, start, total = [], None, 0
+            for production in group:
+                quantity = Uom.convert_qty(production.unit,
+                    production.quantity, production.product.default_uom,
+                    round=False)
+                if batch and ((start and production.planned_date
+                            and production.planned_date - start > window)
+                        or (capacity and total + quantity > capacity)):
+                    batches.append(batch)
+                    batch, total = [], 0
+                if not batch:
+                    start = production.planned_date
+                batch.append(production)
+                total += quantity
+            batches.append(batch)
+
+        to_write = []
+        lines_to_write = []
+        to_delete = []
+        for batch in batches:
+            if len(batch) < 2:
+                continue
+            leader = batch[0]
+            leader.quantity = leader.unit.round(sum(
+                    Uom.convert_qty(p.unit, p.quantity, leader.unit,
+                        round=False) for p in batch))
+            changes = leader.explode_bom()
+            values = prepare_write_vals(changes) if changes else {}
+            values['quantity'] = leader.quantity
+            to_write.extend(([leader], values))
+            lines_to_write.extend(([p.origin for p in batch], {
+                        'production': leader.id,
+                        'merged_production': leader.id,
+                        }))
+            to_delete.extend(batch[1:])
+        if not to_delete:
+            return 0
+        SupplyRequestLine.write(*lines_to_write)
+        cls.delete(to_delete)
+        cls.write(*to_write)
+        return len(to_delete)
+
+    @classmethod
+    @ModelView.button
+    def sequence_day(cls, productions):
+        cls.sequence_days(productions)
+
+    @classmethod
+    def sequence_days(cls, productions):
+        '''
+        Sequence all the pending productions of the warehouses and planned
+        dates of the productions.
+        '''
+        days = {(p.warehouse.id if p.warehouse else None, p.planned_date)
+            for p in productions}
+        to_sequence = []
+        for sub_days in grouped_slice(list(days)):
+            to_sequence.extend(cls.search([
+                        ('state', 'in',
+                            ['request', 'draft', 'waiting', 'assigned']),
+                        ['OR'] + [[
+                                ('warehouse', '=', warehouse_id),
+                                ('planned_date', '=', planned_date),
+                                ] for warehouse_id, planned_date in sub_days],
+                        ]))
+        if to_sequence:
+            cls.sequence_productions(to_sequence)
+
+    @classmethod
+    def sequence_new_productions(cls, productions):
+        '''
+        Sequence the new productions of each warehouse and planned date
+        among themselves after the pending productions already sequenced,
+        which are not written. The sequence_day button sequences them all.
+        '''
+        production_ids = {p.id for p in productions}
+        days = {(p.warehouse.id if p.warehouse else None, p.planned_date)
+            for p in productions}
+        offsets = defaultdict(int)
+        for sub_days in grouped_slice(list(days)):
+            for values in cls.search_read([
+                        ('state', 'in',
+                            ['request', 'draft', 'waiting', 'assigned']),
+                        ('sequence', '!=', None),
+                        ['OR'] + [[
+                                ('warehouse', '=', warehouse_id),
+                                ('planned_date', '=', planned_date),
+                                ] for warehouse_id, planned_date in sub_days],
+                        ], fields_names=['warehouse', 'planned_date',
+                        'sequence']):
+                if values['id'] in production_ids:
+                    continue
+                day = (values['warehouse'], values['planned_date'])
+                offsets[day] = max(offsets[day], values['sequence'])
+        cls.sequence_productions(productions, offsets=offsets)
+
+    @classmethod
+    @instrumented('production.sequence_productions')
+    def sequence_productions(cls, productions, offsets=None):
+        '''
+        Set the sequence of the pending productions of each warehouse and
+        day ordering them to reduce the drugs of their prescriptions carried
+        over between consecutive productions.
+        offsets is a dictionary with the last sequence already used keyed by
+        (warehouse id, planned date), the sequences start after it.
+        '''
+        pool = Pool()
+        PrescriptionLine = pool.get('farm.prescription.line')
+
+        productions = [p for p in productions
+            if p.state in ('request', 'draft', 'waiting', 'assigned')]
+        prescription_ids = list({p.prescription.id for p in productions
+                if p.prescription})
+        drugs = defaultdict(set)
+        for sub_ids in grouped_slice(prescription_ids):
+            for line in PrescriptionLine.search([
+                        ('prescription', 'in', list(sub_ids)),
+                        ]):
+                drugs[line.prescription.id].add(line.product.id)
+
+        if offsets is None:
+            offsets = {}
+        days = defaultdict(list)
+        for production in productions:
+            days[(production.warehouse.id if production.warehouse else None,
+                    production.planned_date)].append(production)
+        sequences = defaultdict(list)
+        for day, day_productions in days.items():
+            day_productions.sort(key=lambda p: p.id)
+            order = carry_over_order([frozenset(drugs[p.prescription.id])
+                    if p.prescription else frozenset()
+                    for p in day_productions])
+            for sequence, index in enumerate(order, offsets.get(day, 0) + 1):
+                sequences[sequence].append(day_productions[index])
+        to_write = []
+        for sequence, records in sequences.items():
+            to_write.extend((records, {'sequence': sequence}))
+        if to_write:
+            cls.write(*to_write)
+
     def _explode_prescription_line_values(self, from_location, to_location,
             company, line):
         move = self._move(from_location, to_location, company, line.product,
@@ -219,148 +1162,651 @@ class Production(metaclass=PoolMeta):
         move.origin = str(line)
         return move._save_values()
 
+    def _explode_prescription_line_move_values(self, line):
+        'Returns the input move values which depend on the prescription line'
+        return {
+            'product': line.product.id,
+            'unit': line.unit.id,
+            'quantity': line.quantity,
+            'prescription': line.prescription.id,
+            'origin': str(line),
+            }
+
+    def _explode_prescription_lines_values(self, from_location, to_location,
+            company, lines):
+        '''
+        Returns a list of (line, input move values) of the prescription lines.
+        The values shared by all the lines are computed once from the move of
+        the first line and the values of each line are built from them and
+        _explode_prescription_line_move_values, without a move per line.
+        '''
+        if not lines:
+            return []
+        shared_values = self._explode_prescription_line_values(from_location,
+            to_location, company, lines[0])
+        if not shared_values:
+            return []
+        lines_values = []
+        for line in lines:
+            values = shared_values.copy()
+            values.update(self._explode_prescription_line_move_values(line))
+            lines_values.append((line, values))
+        return lines_values
+
+    @instrumented('production._assign_reservation')
     def _assign_reservation(self, main_output):
+        '''
+        The reservations of the lines merged into the production follow the
+        reservation of the line which originated it.
+        The lot of the prescription of the reservation is set by do for all
+        the productions at once.
+        '''
         pool = Pool()
-        Prescription = pool.get('farm.prescription')
+        Move = pool.get('stock.move')
 
+        result = super(Production, self)._assign_reservation(main_output)
         reservation = self.origin.move
-        if getattr(main_output, 'lot', False) and reservation.prescription:
-            with Transaction().set_user(0, set_context=True):
-                prescription = Prescription(reservation.prescription.id)
-                prescription.lot = main_output.lot
-                prescription.save()
-        return super(Production, self)._assign_reservation(main_output)
+        moves = [l.move for l in self.merged_lines
+            if l.move and l.move != reservation]
+        if moves:
+            if getattr(main_output, 'lot', False):
+                Move.write(moves, {'lot': main_output.lot.id})
+            if Move(reservation.id).state == 'assigned':
+                Move.assign_try(moves)
+        return result
+
+    def _prescription_lot(self):
+        'Returns the lot of the main output which is set to the prescriptions'
+        for output in self.outputs:
+            if output.lot and output.lot.product == self.product:
+                return output.lot
 
     @classmethod
+    @instrumented('production.assign')
     def assign(cls, productions):
-        for production in productions:
-            if production.prescription:
-                if production.prescription.state not in ('confirmed', 'done'):
-                    raise UserError(gettext('farm_feed_production.'
-                            'msg_prescription_not_confirmed',
-                            prescription=production.prescription.rec_name,
-                            production=production.rec_name,
-                            ))
+        pool = Pool()
+        Prescription = pool.get('farm.prescription')
+
+        prescription_ids = list({p.prescription.id for p in productions
+                if p.prescription})
+        states = {p['id']: p['state']
+            for p in Prescription.read(prescription_ids, ['state'])}
+        pending = [p for p in productions if p.from_supply_request
+            and p.origin.prescription_pending]
+        if pending:
+            raise UserError(gettext('farm_feed_production.'
+                    'msg_production_prescription_pending',
+                    productions=', '.join(p.rec_name for p in pending),
+                    ))
+        blocking = [p for p in productions if p.prescription
+            and states[p.prescription.id] not in ('confirmed', 'done')]
+        if len(blocking) == 1:
+            production, = blocking
+            raise UserError(gettext('farm_feed_production.'
+                    'msg_prescription_not_confirmed',
+                    prescription=production.prescription.rec_name,
+                    production=production.rec_name,
+                    ))
+        elif blocking:
+            raise UserError(gettext('farm_feed_production.'
+                    'msg_prescriptions_not_confirmed',
+                    productions=', '.join('%s (%s)' % (p.rec_name,
+                            p.prescription.rec_name) for p in blocking),
+                    ))
         super(Production, cls).assign(productions)
 
     @classmethod
+    @instrumented('production.do')
     def do(cls, productions):
         pool = Pool()
+        Lot = pool.get('stock.lot')
         Prescription = pool.get('farm.prescription')
 
         super(Production, cls).do(productions)
+        lot_expiry_dates = {}
+        prescription_lots = {}
         prescriptions_todo = []
-        for production in productions:
+        for production in cls.browse([p.id for p in productions]):
+            prescription_lot = production._prescription_lot()
+            prescriptions = []
+            if production.prescription:
+                prescriptions.append(production.prescription)
+            if (production.from_supply_request and production.origin.move
+                    and production.origin.move.prescription):
+                prescriptions.append(production.origin.move.prescription)
+            if prescription_lot:
+                for prescription in prescriptions:
+                    prescription_lots[prescription] = prescription_lot
             if production.prescription:
                 expiry_period = production.prescription.expiry_period
-                prescription_lot = None
-                for output in production.outputs:
-                    if output.lot:
-                        if expiry_period:
-                            output.lot.expiry_date = (output.effective_date +
+                if expiry_period:
+                    for output in production.outputs:
+                        if output.lot:
+                            lot_expiry_dates[output.lot] = (
+                                output.effective_date +
                                 timedelta(days=expiry_period))
-                            output.lot.save()
-                        if output.lot.product == production.product:
-                            prescription_lot = output.lot
-                if prescription_lot:
-                    production.prescription.lot = prescription_lot
-                    production.prescription.save()
                 prescriptions_todo.append(production.prescription)
+        # Write together the lots with the same expiry date and the
+        # prescriptions with the same lot
+        if lot_expiry_dates:
+            lots_by_expiry_date = defaultdict(list)
+            for lot, expiry_date in lot_expiry_dates.items():
+                lots_by_expiry_date[expiry_date].append(lot)
+            to_write = []
+            for expiry_date, lots in lots_by_expiry_date.items():
+                to_write.extend((lots, {'expiry_date': expiry_date}))
+            Lot.write(*to_write)
+        if prescription_lots:
+            prescriptions_by_lot = defaultdict(list)
+            for prescription, lot in prescription_lots.items():
+                prescriptions_by_lot[lot].append(prescription)
+            to_write = []
+            for lot, prescriptions in prescriptions_by_lot.items():
+                to_write.extend((prescriptions, {'lot': lot.id}))
+            with Transaction().set_user(0, set_context=True):
+                Prescription.write(*to_write)
         if prescriptions_todo:
             Prescription.done(prescriptions_todo)
 
     @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Prescription = pool.get('farm.prescription')
+
+        productions = super(Production, cls).create(vlist)
+        prescriptions = {p.prescription for p in productions
+            if p.prescription}
+        if prescriptions:
+            Prescription.set_origin_production(list(prescriptions))
+        return productions
+
+    @classmethod
+    @instrumented('production.write', count_records=count_write_records)
     def write(cls, *args):
         pool = Pool()
         Prescription = pool.get('farm.prescription')
 
         production_ids_qty_uom_modified = []
+        production_ids_origin_modified = set()
+        prescriptions_origin_modified = set()
         actions = iter(args)
         for productions, values in zip(actions, actions):
+            if 'prescription' in values or 'origin' in values:
+                production_ids_origin_modified.update(
+                    p.id for p in productions)
+                prescriptions_origin_modified.update(p.prescription
+                    for p in productions if p.prescription)
             if 'quantity' in values or 'unit' in values:
                 for production in productions:
                     prescription = production.prescription
                     if prescription and prescription.state != 'draft':
-                        raise UserError(gettext('farm_feed_production.'
-                                'msg_no_changes_allowed_prescription_confirmed',
-                                production=production.rec_name,
-                                prescription=prescription.rec_name,
-                                ))
+                        raise UserError(gettext(
+                            'farm_feed_production.'
+                            'msg_no_changes_allowed_prescription_confirmed',
+                            production=production.rec_name,
+                            prescription=prescription.rec_name,
+                            ))
                     elif prescription:
                         production_ids_qty_uom_modified.append(production.id)
 
         super(Production, cls).write(*args)
 
-        for production in cls.browse(production_ids_qty_uom_modified):
-            factor = production.prescription.get_factor_change_quantity_unit(
-                production.quantity, production.unit)
-            if factor is not None:
-                for line in prescription.lines:
-                    line.quantity = line.compute_quantity(factor)
-                    line.save()
-                with Transaction().set_user(0, set_context=True):
-                    prescription = Prescription(prescription.id)
-                    prescription.quantity = prescription.unit.round(
-                        production.quantity * factor)
-                    prescription.save()
+        if production_ids_origin_modified:
+            prescriptions_origin_modified.update(p.prescription
+                for p in cls.browse(list(production_ids_origin_modified))
+                if p.prescription)
+            Prescription.set_origin_production(
+                list(prescriptions_origin_modified))
+        if production_ids_qty_uom_modified:
+            cls.rescale_prescriptions(cls.browse(
+                    list(set(production_ids_qty_uom_modified))))
+
+    @classmethod
+    def rescale_prescriptions(cls, productions):
+        '''
+        Rescale the prescription (and its lines) of the productions to the
+        production's quantity and unit: the prescription gets the quantity of
+        the production converted to its unit and the lines are scaled by the
+        ratio between the new and the old quantity of the prescription.
+        '''
+        pool = Pool()
+        Prescription = pool.get('farm.prescription')
+        PrescriptionLine = pool.get('farm.prescription.line')
+        Uom = pool.get('product.uom')
+
+        line_quantities = {}
+        prescription_quantities = {}
+        Uom.get_conversion_table({u for p in productions
+                for u in (p.unit, p.prescription.unit) if u})
+        for production in productions:
+            prescription = production.prescription
+            quantity = Uom.convert_qty(production.unit, production.quantity,
+                prescription.unit)
+            if quantity == prescription.quantity or not prescription.quantity:
+                continue
+            factor = quantity / prescription.quantity
+            for line in prescription.lines:
+                line_quantities[line] = line.compute_quantity(factor)
+            prescription_quantities[prescription] = quantity
+
+        if line_quantities:
+            lines_by_quantity = defaultdict(list)
+            for line, quantity in line_quantities.items():
+                lines_by_quantity[quantity].append(line)
+            to_write = []
+            for quantity, lines in lines_by_quantity.items():
+                to_write.extend((lines, {'quantity': quantity}))
+            PrescriptionLine.write(*to_write)
+        if prescription_quantities:
+            prescriptions_by_quantity = defaultdict(list)
+            for prescription, quantity in prescription_quantities.items():
+                prescriptions_by_quantity[quantity].append(prescription)
+            to_write = []
+            for quantity, prescriptions in prescriptions_by_quantity.items():
+                to_write.extend((prescriptions, {'quantity': quantity}))
+            with Transaction().set_user(0, set_context=True):
+                Prescription.write(*to_write)
 
 
 class Prescription(metaclass=PoolMeta):
     __name__ = 'farm.prescription'
+    _template_plan_cache = Cache('farm.prescription.template_plan',
+        context=False)
 
-    origin_production = fields.Function(fields.Many2One('production',
-            'Origin Production'),
-        'on_change_with_origin_production')
+    origin_production = fields.Many2One('production', 'Origin Production',
+        readonly=True, ondelete='SET NULL')
 
     @classmethod
     def __setup__(cls):
         super(Prescription, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.origin_production, Index.Range())))
         for fname in ('farm', 'delivery_date', 'product', 'lot', 'quantity'):
             field = getattr(cls, fname)
             field.states['readonly'] = Or(field.states['readonly'],
                 Bool(Eval('origin_production')))
             field.depends.add('origin_production')
 
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        fill_origin_production = not table_h.column_exist(
+            'origin_production')
+
+        super(Prescription, cls).__register__(module_name)
+
+        # Migration from 8.0: origin_production is stored
+        if fill_origin_production:
+            cls._fill_origin_production()
+
+    @classmethod
+    def _fill_origin_production(cls):
+        '''
+        Fill the origin production of all the prescriptions with set-based
+        updates, like set_origin_production does for some of them.
+        '''
+        pool = Pool()
+        Production = pool.get('production')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        production = Production.__table__()
+
+        cursor.execute(*table.update(
+                [table.origin_production],
+                [cls.origin.sql_id(table.origin, Production)],
+                where=Like(table.origin, 'production,%')))
+        cursor.execute(*table.update(
+                [table.origin_production],
+                [production.select(Min(production.id),
+                        where=(production.prescription == table.id)
+                        & (production.origin == table.origin))],
+                where=Like(table.origin, 'stock.supply_request.line,%')))
+
     @classmethod
     def _get_origin(cls):
         res = super(Prescription, cls)._get_origin()
         return res + ['stock.supply_request.line']
 
-    @fields.depends('origin')
-    def on_change_with_origin_production(self, name=None):
+    @classmethod
+    def get_origin_productions(cls, prescriptions):
+        '''
+        Returns a dictionary with the id of the production the prescriptions
+        were created for (or None) keyed by prescription id.
+        This is the production set as origin or, for the supply request
+        lines, the production of the line which uses the prescription.
+        '''
         pool = Pool()
         Production = pool.get('production')
         SupplyRequestLine = pool.get('stock.supply_request.line')
-        if self.origin and isinstance(self.origin, Production):
-            return self.origin.id
-        elif (self.origin and isinstance(self.origin, SupplyRequestLine)
-                and self.origin.production):
-            return self.origin.production.id
+
+        origin_productions = {}
+        line_origins = {}
+        for prescription in prescriptions:
+            origin_productions[prescription.id] = None
+            if isinstance(prescription.origin, Production):
+                origin_productions[prescription.id] = prescription.origin.id
+            elif isinstance(prescription.origin, SupplyRequestLine):
+                line_origins[prescription.id] = str(prescription.origin)
+        for sub_ids in grouped_slice(list(line_origins.keys())):
+            sub_ids = list(sub_ids)
+            for production in Production.search([
+                        ('prescription', 'in', sub_ids),
+                        ('origin', 'in', list({line_origins[i]
+                                    for i in sub_ids})),
+                        ], order=[('id', 'ASC')]):
+                prescription_id = production.prescription.id
+                if (str(production.origin) == line_origins[prescription_id]
+                        and not origin_productions[prescription_id]):
+                    origin_productions[prescription_id] = production.id
+        return origin_productions
+
+    @classmethod
+    def set_origin_production(cls, prescriptions):
+        'Store the origin production of the prescriptions'
+        origin_productions = cls.get_origin_productions(prescriptions)
+        prescriptions_by_production = defaultdict(list)
+        for prescription in prescriptions:
+            production_id = origin_productions[prescription.id]
+            current_id = (prescription.origin_production.id
+                if prescription.origin_production else None)
+            if production_id != current_id:
+                prescriptions_by_production[production_id].append(
+                    prescription)
+        to_write = []
+        for production_id, to_update in prescriptions_by_production.items():
+            to_write.extend((to_update, {'origin_production': production_id}))
+        if to_write:
+            with Transaction().set_user(0, set_context=True):
+                cls.write(*to_write)
+
+    @classmethod
+    def create(cls, vlist):
+        prescriptions = super(Prescription, cls).create(vlist)
+        cls.set_origin_production(prescriptions)
+        return prescriptions
+
+    @classmethod
+    def write(cls, *args):
+        super(Prescription, cls).write(*args)
+        actions = iter(args)
+        to_update = set()
+        for prescriptions, values in zip(actions, actions):
+            if 'origin' in values:
+                to_update.update(prescriptions)
+        if to_update:
+            cls.set_origin_production(cls.browse([p.id for p in to_update]))
+
+    @staticmethod
+    def _template_plan_key(template):
+        'Returns the key of the plan which changes when the template does'
+        return (template.id, str(template.write_date),
+            tuple((l.id, str(l.write_date)) for l in template.lines))
+
+    @staticmethod
+    def _stored_field_names(Model):
+        'Returns the names of the stored fields of the Model but the ids'
+        return sorted(n for n, f in Model._fields.items()
+            if not isinstance(f, (fields.Function, fields.One2Many,
+                    fields.Many2Many))
+            and n not in {'id', 'create_uid', 'create_date', 'write_uid',
+                'write_date'})
+
+    @classmethod
+    def _compile_template_plan(cls, before, after, lines):
+        '''
+        Returns the plan of the template from the values of a prescription
+        before and after the parent set_template and the values of the
+        lines it created, or None if the template changes the quantity of
+        the prescription so its lines can not be scaled.
+        The plan has the values which must be equal on a prescription to
+        apply it (the ones the template also defines and the ones changed but
+        the quantity and unit), the values changed, the quantity of the
+        prescription and the values of the lines for this quantity.
+        '''
+        pool = Pool()
+        Template = pool.get('farm.prescription.template')
+
+        changed = {n: v for n, v in after.items()
+            if n != 'id' and v != before[n]}
+        if 'quantity' in changed or not after['quantity']:
+            return None
+        names = (set(Template._fields) & set(before)) | set(changed)
+        names -= {'id', 'quantity', 'unit'}
+        required = {n: before[n] for n in names}
+        lines = [{n: v for n, v in l.items() if n not in {'id',
+                        'prescription'}}
+            for l in lines]
+        return required, changed, after['quantity'], lines
+
+    @classmethod
+    @instrumented('farm.prescription.set_template')
+    def set_template(cls, prescriptions):
+        '''
+        Apply the template to the prescriptions using the compiled plan of
+        each template and unit.
+        The template is applied by the parent method to one prescription
+        without lines of each template and unit not compiled yet, and its
+        changes and lines are kept as the plan. The lines of the plan are
+        scaled to the quantity of the rest of prescriptions with the same
+        values on the fields the template defines, which get the changes with
+        grouped writes and their lines with a single create. The parent
+        method is used for the rest.
+        '''
+        pool = Pool()
+        Production = pool.get('production')
+        PrescriptionLine = pool.get('farm.prescription.line')
+
+        names = cls._stored_field_names(cls)
+        line_names = cls._stored_field_names(PrescriptionLine)
+        to_super = [p for p in prescriptions if not p.template or p.lines]
+        candidates = [p for p in prescriptions if p.template and not p.lines]
+        before = {v['id']: v
+            for v in cls.read([p.id for p in candidates], names)}
+
+        groups = defaultdict(list)
+        for prescription in candidates:
+            groups[(cls._template_plan_key(prescription.template),
+                    prescription.unit.id if prescription.unit else None)
+                ].append(prescription)
+        plans, representatives = {}, {}
+        for key, records in groups.items():
+            plan = cls._template_plan_cache.get(key)
+            if plan is None:
+                representatives[key] = records.pop(0)
+                to_super.append(representatives[key])
+            else:
+                plans[key] = plan
+        if to_super:
+            super(Prescription, cls).set_template(to_super)
+        if representatives:
+            after = {v['id']: v for v in cls.read(
+                    [p.id for p in representatives.values()], names)}
+            lines = defaultdict(list)
+            for values in PrescriptionLine.read([l.id
+                        for p in cls.browse(list(after))
+                        for l in p.lines], line_names + ['prescription']):
+                lines[values['prescription']].append(values)
+            for key, prescription in representatives.items():
+                plans[key] = cls._compile_template_plan(
+                    before[prescription.id], after[prescription.id],
+                    lines[prescription.id])
+                if plans[key] is not None:
+                    cls._template_plan_cache.set(key, plans[key])
+
+        to_super = []
+        to_write = defaultdict(list)
+        to_create = []
+        for key, records in groups.items():
+            if plans[key] is None:
+                to_super.extend(records)
+                continue
+            required, changed, quantity, lines = plans[key]
+            plan = cls(quantity=quantity)
+            for prescription in records:
+                values = before[prescription.id]
+                if any(values[n] != v for n, v in required.items()):
+                    to_super.append(prescription)
+                    continue
+                if changed:
+                    to_write[tuple(sorted(changed.items()))].append(
+                        prescription)
+                plan.unit = prescription.unit
+                factor = Production.get_prescription_factor(plan,
+                    prescription.quantity, prescription.unit)
+                for line_values in lines:
+                    line_values = line_values.copy()
+                    if factor is not None:
+                        line_values['quantity'] = PrescriptionLine(
+                            **line_values).compute_quantity(factor)
+                    line_values['prescription'] = prescription.id
+                    to_create.append(line_values)
+        if to_write:
+            args = []
+            for values, records in to_write.items():
+                args.extend((records, dict(values)))
+            cls.write(*args)
+        if to_create:
+            PrescriptionLine.create(to_create)
+        if to_super:
+            super(Prescription, cls).set_template(to_super)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('confirmed')
+    @instrumented('farm.prescription.confirm')
     def confirm(cls, prescriptions):
         pool = Pool()
         Production = pool.get('production')
 
         super(Prescription, cls).confirm(prescriptions)
-        for prescription in prescriptions:
-            if prescription.origin_production:
+        productions = {p.origin_production for p in prescriptions
+            if p.origin_production
+            and p.origin_production.state in ('request', 'draft', 'waiting')}
+        if productions:
+            with Transaction().set_user(0, set_context=True):
+                Production.explode_boms(list(productions))
+
+    @classmethod
+    def traceability(cls, farms=None, start_date=None, end_date=None,
+            drugs=None, chunk_size=None):
+        '''
+        Yields a dictionary for each drug line of the prescriptions of the
+        farms, between the dates and with the drugs (all if None) with the
+        traceability of the medicated feed: the prescription, its production,
+        the supply request and the lots of the drug consumed.
+        The prescriptions are read in chunks ordered by id, so the memory
+        used doesn't depend on the number of prescriptions.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        SupplyRequestLine = pool.get('stock.supply_request.line')
+
+        if chunk_size is None:
+            chunk_size = Transaction().database.IN_MAX
+        domain = []
+        if farms:
+            domain.append(('farm', 'in', [int(f) for f in farms]))
+        if start_date:
+            domain.append(('date', '>=', start_date))
+        if end_date:
+            domain.append(('date', '<=', end_date))
+        drug_ids = None
+        if drugs:
+            drug_ids = {int(d) for d in drugs}
+            domain.append(('lines.product', 'in', list(drug_ids)))
+
+        last_id = 0
+        while True:
+            prescriptions = cls.search(domain + [
+                    ('id', '>', last_id),
+                    ], order=[('id', 'ASC')], limit=chunk_size)
+            if not prescriptions:
+                break
+            last_id = prescriptions[-1].id
+
+            drug_lots = defaultdict(set)
+            productions = [p.origin_production.id for p in prescriptions
+                if p.origin_production]
+            for move in Move.search([
+                        ('production_input', 'in', productions),
+                        ('prescription', '!=', None),
+                        ('state', '!=', 'cancelled'),
+                        ]):
+                if move.lot:
+                    drug_lots[str(move.origin)].add(move.lot.rec_name)
+
+            for prescription in prescriptions:
                 production = prescription.origin_production
-                if production.state not in ('request', 'draft', 'waiting'):
-                    continue
-                with Transaction().set_user(0, set_context=True):
-                    Production.write([production],
-                        prepare_write_vals(production.explode_bom()))
+                supply_request = None
+                if isinstance(prescription.origin, SupplyRequestLine):
+                    supply_request = prescription.origin.request
+                for line in prescription.lines:
+                    if drug_ids and line.product.id not in drug_ids:
+                        continue
+                    yield {
+                        'prescription': prescription.rec_name,
+                        'date': prescription.date,
+                        'farm': prescription.farm.rec_name,
+                        'feed': prescription.product.rec_name,
+                        'feed_lot': (prescription.lot.rec_name
+                            if prescription.lot else None),
+                        'quantity': prescription.quantity,
+                        'unit': prescription.unit.rec_name,
+                        'production': (production.rec_name
+                            if production else None),
+                        'supply_request': (supply_request.rec_name
+                            if supply_request else None),
+                        'drug': line.product.rec_name,
+                        'drug_quantity': line.quantity,
+                        'drug_unit': line.unit.rec_name,
+                        'drug_lots': ', '.join(sorted(drug_lots[str(line)])),
+                        }
 
     @classmethod
+    def export_traceability(cls, file, format='csv', **filters):
+        '''
+        Write the traceability rows (see traceability for the filters) to
+        the text file as CSV or JSON lines (format "jsonl").
+        Returns the number of rows written.
+        '''
+        assert format in {'csv', 'jsonl'}
+        rows = cls.traceability(**filters)
+        count = 0
+        if format == 'csv':
+            writer = None
+            for row in rows:
+                if writer is None:
+                    writer = csv.DictWriter(file, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                file.write(json.dumps(row, default=str))
+                file.write('\n')
+                count += 1
+        return count
+
+    @classmethod
+    @instrumented('farm.prescription.delete')
     def delete(cls, prescriptions):
-        for prescription in prescriptions:
-            if prescription.origin_production:
-                raise UserError(gettext('farm_feed_production.'
-                        'msg_cant_delete_productions_prescription',
-                        prescription=prescription.rec_name,
-                        production=prescription.origin_production.rec_name,
-                        ))
+        linked = []
+        for sub_prescriptions in grouped_slice(prescriptions):
+            linked.extend(cls.search([
+                        ('id', 'in', [p.id for p in sub_prescriptions]),
+                        ('origin_production', '!=', None),
+                        ], order=[('id', 'ASC')]))
+        if len(linked) == 1:
+            prescription, = linked
+            raise UserError(gettext('farm_feed_production.'
+                    'msg_cant_delete_productions_prescription',
+                    prescription=prescription.rec_name,
+                    production=prescription.origin_production.rec_name,
+                    ))
+        elif linked:
+            raise UserError(gettext('farm_feed_production.'
+                    'msg_cant_delete_productions_prescriptions',
+                    prescriptions=', '.join('%s (%s)' % (p.rec_name,
+                            p.origin_production.rec_name) for p in linked),
+                    ))
         super(Prescription, cls).delete(prescriptions)
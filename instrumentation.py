@@ -0,0 +1,150 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Opt-in instrumentation of the feed production operations.
+
+It is enabled with the "feed_production_instrumentation" context key or the
+"instrumentation" option of the "farm_feed_production" section of the
+configuration file. When enabled, each call to an instrumented method
+records the number of SQL queries executed, the time spent and the number of
+records processed. The summary of the transaction is available with
+summary() and is logged when the transaction ends.
+'''
+import functools
+import logging
+import time
+from collections import defaultdict
+from weakref import WeakKeyDictionary
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['QueryCounter', 'instrumented', 'count_write_records', 'enabled',
+    'summary']
+
+logger = logging.getLogger(__name__)
+_stats = WeakKeyDictionary()
+
+
+class QueryCounter(object):
+    'Connection wrapper which counts the executed SQL queries'
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self,
+            self.connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class _CountingCursor(object):
+
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def enabled():
+    'Returns if the instrumentation is enabled for the current transaction'
+    return bool(Transaction().context.get('feed_production_instrumentation')
+        or config.getboolean('farm_feed_production', 'instrumentation',
+            default=False))
+
+
+def _count_records(*args, **kwargs):
+    if args and isinstance(args[0], (list, tuple)):
+        return len(args[0])
+    return 1
+
+
+def count_write_records(*args, **kwargs):
+    'Returns the number of records of the arguments of a write call'
+    return sum(len(records) for records in args[::2])
+
+
+def instrumented(name, count_records=None):
+    '''
+    Decorator which records the queries, time and records of each call to
+    the method when the instrumentation is enabled.
+    By default the records are the length of the first argument if it is a
+    list and 1 otherwise.
+    '''
+    if count_records is None:
+        count_records = _count_records
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self_or_cls, *args, **kwargs):
+            if not enabled():
+                return func(self_or_cls, *args, **kwargs)
+            transaction = Transaction()
+            counter = transaction.connection
+            outermost = not isinstance(counter, QueryCounter)
+            if outermost:
+                counter = transaction.connection = QueryCounter(
+                    transaction.connection)
+            queries = counter.count
+            start = time.perf_counter()
+            try:
+                return func(self_or_cls, *args, **kwargs)
+            finally:
+                _record(transaction, name, counter.count - queries,
+                    time.perf_counter() - start,
+                    count_records(*args, **kwargs))
+                if outermost:
+                    transaction.connection = counter.connection
+        return wrapper
+    return decorator
+
+
+def _record(transaction, name, queries, duration, records):
+    if transaction not in _stats:
+        _stats[transaction] = defaultdict(lambda: {
+                'calls': 0,
+                'queries': 0,
+                'time': 0.,
+                'records': 0,
+                })
+        transaction.atexit(_log_summary, transaction)
+    stats = _stats[transaction][name]
+    stats['calls'] += 1
+    stats['queries'] += queries
+    stats['time'] += duration
+    stats['records'] += records
+
+
+def summary(transaction=None):
+    '''
+    Returns a dictionary with the calls, queries, time and records of each
+    instrumented operation of the transaction (the current by default).
+    The values of nested operations are included in their callers.
+    '''
+    if transaction is None:
+        transaction = Transaction()
+    return {k: dict(v) for k, v in _stats.get(transaction, {}).items()}
+
+
+def _log_summary(transaction):
+    for name, stats in sorted(summary(transaction).items(),
+            key=lambda x: x[1]['time'], reverse=True):
+        logger.info('%s: %s calls, %s queries, %.3fs, %s records', name,
+            stats['calls'], stats['queries'], stats['time'],
+            stats['records'])
@@ -0,0 +1,72 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import namedtuple, defaultdict
+
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['Location']
+
+FedAnimals = namedtuple('FedAnimals', ['animals', 'animal_groups', 'heads'])
+
+
+class Location(metaclass=PoolMeta):
+    __name__ = 'stock.location'
+
+    @classmethod
+    def get_fed_animals(cls, silos, date=None):
+        '''
+        Returns a dictionary with the FedAnimals (the animals, animal groups
+        and number of heads in the locations fed by the silo) of each silo
+        keyed by silo id.
+        The stock of all the fed locations is computed at once and their lots
+        are matched with the animals and groups with a query per slice.
+        '''
+        pool = Pool()
+        Animal = pool.get('farm.animal')
+        AnimalGroup = pool.get('farm.animal.group')
+        Date = pool.get('ir.date')
+        Product = pool.get('product.product')
+
+        fed_locations = {s.id: [l.id for l in s.locations_to_fed]
+            for s in silos}
+        location_ids = list({l for ls in fed_locations.values() for l in ls})
+        quantities = {}
+        if location_ids:
+            with Transaction().set_context(
+                    stock_date_end=date or Date.today()):
+                quantities = Product.products_by_location(location_ids,
+                    with_childs=True, grouping=('product', 'lot'))
+
+        lot_quantities = defaultdict(dict)
+        for (location_id, _, lot_id), quantity in quantities.items():
+            if lot_id is not None and quantity > 0:
+                lot_quantities[location_id][lot_id] = quantity
+        lot_ids = list({l for q in lot_quantities.values() for l in q})
+        animals, groups = {}, {}
+        for sub_ids in grouped_slice(lot_ids):
+            sub_ids = list(sub_ids)
+            animals.update((a.lot.id, a) for a in Animal.search([
+                        ('lot', 'in', sub_ids),
+                        ]))
+            groups.update((g.lot.id, g) for g in AnimalGroup.search([
+                        ('lot', 'in', sub_ids),
+                        ]))
+
+        result = {}
+        for silo_id, location_ids in fed_locations.items():
+            silo_animals, silo_groups = {}, {}
+            heads = 0.
+            for location_id in location_ids:
+                for lot_id, quantity in lot_quantities[location_id].items():
+                    if lot_id in animals:
+                        silo_animals[lot_id] = animals[lot_id]
+                    elif lot_id in groups:
+                        silo_groups[lot_id] = groups[lot_id]
+                    else:
+                        continue
+                    heads += quantity
+            result[silo_id] = FedAnimals(list(silo_animals.values()),
+                list(silo_groups.values()), heads)
+        return result
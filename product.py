@@ -0,0 +1,160 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import namedtuple
+from decimal import Decimal
+
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from .cache import TransactionCache
+
+__all__ = ['Template', 'Product', 'ProductCostPrice']
+
+PrescriptionInfo = namedtuple('PrescriptionInfo', ['required', 'template'])
+
+
+class Template(metaclass=PoolMeta):
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Product = pool.get('product.product')
+        super(Template, cls).write(*args)
+        Product._clear_cache([p for templates in args[::2]
+                for t in templates for p in t.products])
+
+    @classmethod
+    def delete(cls, templates):
+        pool = Pool()
+        Product = pool.get('product.product')
+        products = [p for t in templates for p in t.products]
+        super(Template, cls).delete(templates)
+        Product._clear_cache(products)
+
+
+class Product(metaclass=PoolMeta):
+    __name__ = 'product.product'
+    _prescription_info_cache = TransactionCache(
+        'product.product.get_prescription_info')
+    _cost_price_cache = TransactionCache('product.product.get_cost_prices')
+
+    @classmethod
+    def get_prescription_info(cls, products):
+        '''
+        Returns a dictionary with the PrescriptionInfo (if it requires
+        prescription and the id of its prescription template) of each
+        product keyed by product id.
+        The values are kept for the transaction and the products not kept yet
+        are read with a single query.
+        '''
+        infos = {}
+        missing = set()
+        for product in products:
+            product_id = int(product)
+            info = cls._prescription_info_cache.get(product_id)
+            if info is None:
+                missing.add(product_id)
+            else:
+                infos[product_id] = PrescriptionInfo(*info)
+        if missing:
+            for values in cls.read(list(missing),
+                    ['prescription_required', 'prescription_template']):
+                info = (bool(values['prescription_required']),
+                    values['prescription_template'])
+                cls._prescription_info_cache.set(values['id'], info)
+                infos[values['id']] = PrescriptionInfo(*info)
+        return infos
+
+    @classmethod
+    def get_cost_prices(cls, products):
+        '''
+        Returns a dictionary with the cost price of each product for the
+        company of the context keyed by product id.
+        The prices are kept for the transaction by product, company and date
+        and the products not kept yet are read with a single query.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+
+        company = Transaction().context.get('company')
+        today = Date.today()
+        prices = {}
+        missing = set()
+        for product in products:
+            product_id = int(product)
+            price = cls._cost_price_cache.get(product_id, {}).get(
+                (company, today))
+            if price is None:
+                missing.add(product_id)
+            else:
+                prices[product_id] = price
+        if missing:
+            for values in cls.read(list(missing), ['cost_price']):
+                price = values['cost_price'] or Decimal(0)
+                product_prices = cls._cost_price_cache.get(values['id'])
+                if product_prices is None:
+                    product_prices = {}
+                    cls._cost_price_cache.set(values['id'], product_prices)
+                product_prices[(company, today)] = price
+                prices[values['id']] = price
+        return prices
+
+    @classmethod
+    def _clear_cache(cls, products):
+        '''
+        Clear the values kept for the products.
+        The kept BOM explosions don't depend on the cost prices as their cost
+        is computed again each time they are used.
+        '''
+        product_ids = {int(p) for p in products}
+        cls._prescription_info_cache.delete(product_ids)
+        cls._cost_price_cache.delete(product_ids)
+
+    @classmethod
+    def create(cls, vlist):
+        products = super(Product, cls).create(vlist)
+        cls._clear_cache(products)
+        return products
+
+    @classmethod
+    def write(cls, *args):
+        super(Product, cls).write(*args)
+        cls._clear_cache([p for products in args[::2] for p in products])
+
+    @classmethod
+    def delete(cls, products):
+        super(Product, cls).delete(products)
+        cls._clear_cache(products)
+
+
+class ProductCostPrice(metaclass=PoolMeta):
+    __name__ = 'product.cost_price'
+
+    # The cost prices are updated through these records, ie: by the moves
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Product = pool.get('product.product')
+        records = super(ProductCostPrice, cls).create(vlist)
+        Product._clear_cache([r.product for r in records if r.product])
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Product = pool.get('product.product')
+        records = [r for records in args[::2] for r in records]
+        products = {r.product for r in records if r.product}
+        super(ProductCostPrice, cls).write(*args)
+        products.update(r.product
+            for r in cls.browse([r.id for r in records]) if r.product)
+        Product._clear_cache(products)
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Product = pool.get('product.product')
+        products = [r.product for r in records if r.product]
+        super(ProductCostPrice, cls).delete(records)
+        Product._clear_cache(products)
@@ -0,0 +1,267 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the feed production hot paths.
+
+It creates a synthetic data set (farms, silos, BOMs, drug products and
+supply requests) on the database configured for the tests and times the
+entry points overridden by this module, recording the wall time and the
+number of SQL queries of each one as JSON:
+
+    DB_NAME=bench TRYTOND_DATABASE_URI=postgresql:// \\
+    python -m trytond.modules.farm_feed_production.tests.\\
+benchmark_feed_production --farms 5 --lines 50 --output bench.json
+
+Without DB_NAME/TRYTOND_DATABASE_URI an in-memory SQLite database is used.
+The database is dropped at the end, so the benchmark refuses to run on a
+database that already exists.
+'''
+import argparse
+import datetime
+import json
+import sys
+import time
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.farm_feed_production.instrumentation import (
+    QueryCounter, summary)
+from trytond.modules.farm_feed_production.tests.tools import (
+    create_farm, create_supply_request, setup_feed_production)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, db_exist, drop_db
+from trytond.transaction import Transaction
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the farm_feed_production hot paths')
+    parser.add_argument('--farms', type=int, default=2,
+        help='number of farms (one supply request per farm)')
+    parser.add_argument('--silos', type=int, default=2,
+        help='number of silos per farm')
+    parser.add_argument('--lines', type=int, default=10,
+        help='number of lines per supply request')
+    parser.add_argument('--drugs', type=int, default=3,
+        help='number of drug lines per prescription')
+    parser.add_argument('--medicated', type=float, default=0.5,
+        help='ratio of the lines of medicated feed')
+    parser.add_argument('--label', default='',
+        help='label stored in the result (ie: the commit)')
+    parser.add_argument('--output', default='-',
+        help='file where the JSON result is written ("-" for stdout)')
+    return parser.parse_args(args)
+
+
+def create_data(options):
+    '''
+    Create the synthetic data set with proteus on top of the data shared by
+    the scenarios and return its ids
+    '''
+    data = setup_feed_production()
+    config = data.config
+
+    ProductTemplate = Model.get('product.template')
+    Product = Model.get('product.product')
+    drugs = [data.drug]
+    for i in range(1, options.drugs):
+        template = ProductTemplate(name='Drug %s' % i, default_uom=data.gr,
+            type='goods', list_price=Decimal('1'), cost_price=Decimal('0.1'),
+            prescription_required=True)
+        template.save()
+        drug = Product(template=template)
+        drug.save()
+        drugs.append(drug)
+
+    Location = Model.get('stock.location')
+    requests = []
+    for farm_number in range(options.farms):
+        if farm_number:
+            farm, _, _, silo = create_farm(config, data.specie,
+                'Farm %s' % farm_number)
+        else:
+            farm, silo = data.farm, data.silo
+        silos = [silo]
+        for silo_number in range(1, options.silos):
+            location = Location(name='Farm %s Location %s' % (
+                    farm_number, silo_number),
+                type='storage', parent=farm.storage_location)
+            location.save()
+            silo = Location(name='Farm %s Silo %s' % (
+                    farm_number, silo_number),
+                type='storage', parent=farm.storage_location, silo=True,
+                locations_to_fed=[location.id])
+            silo.save()
+            silos.append(silo)
+
+        medicated = int(options.lines * options.medicated)
+        requests.append(create_supply_request(data, [
+                    (data.medicated_feed if i < medicated else data.feed,
+                        100, silos[i % len(silos)])
+                    for i in range(options.lines)], to_warehouse=farm))
+
+    return {
+        'user': config.user,
+        'context': config.context,
+        'requests': [r.id for r in requests],
+        'drugs': [d.id for d in drugs],
+        'veterinarian': data.veterinarian.id,
+        }
+
+
+def measure(data, name, function, results):
+    '''
+    Run function in its own transaction, which is committed, and store the
+    wall time, number of queries and number of records it processed and the
+    summary of the instrumented operations.
+    '''
+    context = data['context'].copy()
+    context['feed_production_instrumentation'] = True
+    with Transaction().start(DB_NAME, data['user'],
+            context=context) as transaction:
+        connection = transaction.connection
+        counter = QueryCounter(connection)
+        transaction.connection = counter
+        try:
+            start = time.perf_counter()
+            records = function()
+            wall_time = time.perf_counter() - start
+        finally:
+            transaction.connection = connection
+        operations = summary(transaction)
+        transaction.commit()
+    results[name] = {
+        'wall_time': wall_time,
+        'queries': counter.count,
+        'records': records,
+        'operations': operations,
+        }
+
+
+def run(data, options):
+    pool = Pool(DB_NAME)
+    SupplyRequest = pool.get('stock.supply_request')
+    Production = pool.get('production')
+    Prescription = pool.get('farm.prescription')
+    PrescriptionLine = pool.get('farm.prescription.line')
+    Product = pool.get('product.product')
+    results = {}
+
+    def requests():
+        return SupplyRequest.browse(data['requests'])
+
+    def productions():
+        return Production.search([
+                ('origin.request', 'in', data['requests'],
+                    'stock.supply_request.line'),
+                ])
+
+    def prescriptions():
+        return Prescription.search([
+                ('origin.request', 'in', data['requests'],
+                    'stock.supply_request.line'),
+                ])
+
+    def confirm_requests():
+        SupplyRequest.confirm(requests())
+        return sum(len(r.lines) for r in requests())
+    measure(data, 'supply_request_confirm', confirm_requests, results)
+
+    # Add the drug lines to the prescriptions (not measured)
+    with Transaction().start(DB_NAME, data['user'],
+            context=data['context']) as transaction:
+        to_create = []
+        for prescription in prescriptions():
+            for drug_id in data['drugs']:
+                to_create.append({
+                        'prescription': prescription.id,
+                        'product': drug_id,
+                        'unit': Product(drug_id).default_uom.id,
+                        'quantity': 10,
+                        })
+        PrescriptionLine.create(to_create)
+        Prescription.write(prescriptions(),
+            {'veterinarian': data['veterinarian']})
+        transaction.commit()
+
+    def explode_bom():
+        records = productions()
+        for production in records:
+            production.explode_bom()
+        return len(records)
+    measure(data, 'production_explode_bom', explode_bom, results)
+
+    def prescription_confirm():
+        records = prescriptions()
+        Prescription.confirm(records)
+        return len(records)
+    measure(data, 'prescription_confirm', prescription_confirm, results)
+
+    def check_prescription():
+        records = productions()
+        Production.check_prescriptions(records)
+        return len(records)
+    measure(data, 'production_check_prescription', check_prescription,
+        results)
+
+    # Move the productions to waiting (not measured)
+    with Transaction().start(DB_NAME, data['user'],
+            context=data['context']) as transaction:
+        records = productions()
+        Production.draft([p for p in records if p.state == 'request'])
+        Production.wait(productions())
+        transaction.commit()
+
+    def assign():
+        records = productions()
+        Production.assign(records)
+        return len(records)
+    measure(data, 'production_assign', assign, results)
+
+    with Transaction().start(DB_NAME, data['user'],
+            context=data['context']) as transaction:
+        Production.run(productions())
+        transaction.commit()
+
+    def do():
+        records = productions()
+        Production.do(records)
+        return len(records)
+    measure(data, 'production_do', do, results)
+    return results
+
+
+def main(args=None):
+    options = parse_arguments(args)
+    if DB_NAME != ':memory:' and db_exist(DB_NAME):
+        sys.exit('The database "%s" already exists and it would be dropped '
+            'by the benchmark, set DB_NAME to a dedicated database.'
+            % DB_NAME)
+    try:
+        data = create_data(options)
+        results = run(data, options)
+    finally:
+        drop_db()
+    output = {
+        'label': options.label,
+        'date': datetime.datetime.now().isoformat(),
+        'database': DB_NAME,
+        'parameters': {
+            'farms': options.farms,
+            'silos': options.silos,
+            'lines': options.lines,
+            'drugs': options.drugs,
+            'medicated': options.medicated,
+            },
+        'results': results,
+        }
+    if options.output == '-':
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,79 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import math
+from types import SimpleNamespace
+from unittest.mock import patch
 
 from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 
 
 class FarmFeedProductionTestCase(CompanyTestMixin, ModuleTestCase):
     'Test FarmFeedProduction module'
     module = 'farm_feed_production'
 
+    @with_transaction()
+    def test_confirm_by_warehouse(self):
+        'Test the groups and the failures of confirm_by_warehouse'
+        pool = Pool()
+        SupplyRequest = pool.get('stock.supply_request')
+
+        requests = [SimpleNamespace(id=id_,
+                to_warehouse=SimpleNamespace(id=warehouse_id))
+            for id_, warehouse_id in [(1, 10), (2, 10), (3, 20), (4, 30)]]
+        calls = []
+
+        def confirm_transaction(database_name, user, context, ids):
+            calls.append(tuple(ids))
+            if {2, 4} & set(ids):
+                return 'Request %s failed' % ', '.join(map(str, ids))
+
+        with patch.object(SupplyRequest, '_confirm_transaction',
+                confirm_transaction):
+            failures = SupplyRequest.confirm_by_warehouse(requests,
+                workers=2)
+
+        # A failed group is retried request by request
+        self.assertEqual(sorted(calls), [(1,), (1, 2), (2,), (3,), (4,)])
+        self.assertEqual(sorted(failures), [
+                (2, 'Request 2 failed'),
+                (4, 'Request 4 failed'),
+                ])
+
+    @with_transaction()
+    def test_convert_qty(self):
+        'Test convert_qty returns the rounded quantities of compute_qty'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        UomCategory = pool.get('product.uom.category')
+
+        accurate_fields = set()
+        for category in UomCategory.search([]):
+            uoms = Uom.search([('category', '=', category.id)])
+            accurate_fields.update(u.accurate_field for u in uoms)
+            for from_uom in uoms:
+                for to_uom in uoms:
+                    for qty in [0, 1, 0.15, 7.3333, 1250.5]:
+                        msg = '%s %s to %s' % (qty, from_uom.name,
+                            to_uom.name)
+                        self.assertEqual(
+                            Uom.convert_qty(from_uom, qty, to_uom),
+                            Uom.compute_qty(from_uom, qty, to_uom),
+                            msg=msg)
+                        self.assertTrue(math.isclose(
+                                Uom.convert_qty(from_uom, qty, to_uom,
+                                    round=False),
+                                Uom.compute_qty(from_uom, qty, to_uom,
+                                    round=False),
+                                rel_tol=1e-12), msg=msg)
+        self.assertEqual(accurate_fields, {'factor', 'rate'})
+
+        kilogram, = Uom.search([('name', '=', 'Kilogram')])
+        self.assertEqual(Uom.convert_qty(None, 5, None), 5)
+        with self.assertRaises(ValueError):
+            Uom.convert_qty(kilogram, 5, None)
+
 
 del ModuleTestCase
@@ -285,8 +285,8 @@ class Test(unittest.TestCase):
                                    initial_quantity=4)
         animal_group.save()
 
-        # Create a supply request of 100 Kg of feed for individuals in location L1 and
-        # 100 Kg of feed with prescription for grop in location L2
+        # Create a supply request of 100 Kg of feed for individuals in location
+        # L1 and 100 Kg of feed with prescription for grop in location L2
         SupplyRequest = Model.get('stock.supply_request')
         supply_request = SupplyRequest(company=company,
                                        from_warehouse=warehouse,
@@ -302,8 +302,8 @@ class Test(unittest.TestCase):
         line2.to_location = location2
         supply_request.save()
 
-        # Confirm supply request and check that moves, productions and prescriptions has
-        # been created
+        # Confirm supply request and check that moves, productions and
+        # prescriptions has been created
         supply_request.click('confirm')
         self.assertEqual(supply_request.state, 'confirmed')
 
@@ -0,0 +1,131 @@
+import unittest
+from decimal import Decimal
+
+from trytond.modules.farm_feed_production.tests.tools import (
+    server_transaction, setup_feed_production)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+    'Test the caches of the feed productions'
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+        self.data = setup_feed_production()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test_farm_lines(self):
+        'A farm line write is seen by get_farm_lines in the same transaction'
+        data = self.data
+
+        with server_transaction(data.config):
+            pool = Pool()
+            FarmLine = pool.get('farm.specie.farm_line')
+
+            farm_lines = FarmLine.get_farm_lines([data.farm.id,
+                    data.warehouse.id])
+            line = farm_lines[data.farm.id]
+            self.assertEqual(line.specie.id, data.specie.id)
+            self.assertIsNone(farm_lines[data.warehouse.id])
+
+            FarmLine.write([line], {'farm': data.warehouse.id})
+            farm_lines = FarmLine.get_farm_lines([data.farm.id,
+                    data.warehouse.id])
+            self.assertIsNone(farm_lines[data.farm.id])
+            self.assertEqual(farm_lines[data.warehouse.id], line)
+
+        # The lines kept by a transaction are not seen by the next one
+        with server_transaction(data.config):
+            pool = Pool()
+            FarmLine = pool.get('farm.specie.farm_line')
+
+            farm_lines = FarmLine.get_farm_lines([data.farm.id,
+                    data.warehouse.id])
+            self.assertEqual(farm_lines[data.farm.id], line)
+            self.assertIsNone(farm_lines[data.warehouse.id])
+
+    def test_current_bom_versions(self):
+        'A new BOM version is seen by get_current_versions at once'
+        data = self.data
+
+        with server_transaction(data.config):
+            pool = Pool()
+            BOM = pool.get('production.bom')
+
+            master = BOM(data.feed_bom.id)
+            self.assertEqual(BOM.get_current_versions([master]),
+                {master.id: None})
+
+            version2, version3 = BOM.copy([master, master], default={
+                    'master_bom': master.id,
+                    })
+            BOM.write([version2], {'version': 2}, [version3], {'version': 3})
+            self.assertEqual(BOM.get_current_versions([master]),
+                {master.id: version3})
+
+            # The highest version is the current one, not the latest created
+            BOM.write([version2], {'version': 4})
+            self.assertEqual(BOM.get_current_versions([master]),
+                {master.id: version2})
+
+            BOM.delete([version2])
+            self.assertEqual(BOM.get_current_versions([master]),
+                {master.id: version3})
+
+    def test_cost_prices(self):
+        'A cost price update is seen by the next explosion'
+        data = self.data
+
+        with server_transaction(data.config):
+            pool = Pool()
+            Product = pool.get('product.product')
+            Production = pool.get('production')
+
+            component1 = Product(data.feed_components[0].id)
+
+            def explode_bom():
+                production = Production(company=data.company.id,
+                    warehouse=data.warehouse.id,
+                    location=data.warehouse.production_location.id,
+                    product=data.feed.id, bom=data.feed_bom.id,
+                    unit=data.kg.id, quantity=100)
+                with Transaction().set_context(explode_bom_incremental=True):
+                    return production.explode_bom()
+
+            self.assertEqual(Product.get_cost_prices([component1]),
+                {component1.id: Decimal('20')})
+            # 85 kg of the first component and 15 kg of the second one
+            self.assertEqual(explode_bom()['cost'], Decimal('2150'))
+            self.assertEqual(explode_bom()['cost'], Decimal('2150'))
+
+            Product.write([component1], {'cost_price': Decimal('22')})
+            self.assertEqual(Product.get_cost_prices([component1]),
+                {component1.id: Decimal('22')})
+            self.assertEqual(explode_bom()['cost'], Decimal('2320'))
+
+    def test_prescription_info(self):
+        'A prescription_required change is seen by get_prescription_info'
+        data = self.data
+
+        with server_transaction(data.config):
+            pool = Pool()
+            Product = pool.get('product.product')
+            Template = pool.get('product.template')
+
+            feed = Product(data.feed.id)
+            medicated_feed = Product(data.medicated_feed.id)
+            infos = Product.get_prescription_info([feed, medicated_feed])
+            self.assertFalse(infos[feed.id].required)
+            self.assertTrue(infos[medicated_feed.id].required)
+
+            Template.write([feed.template], {'prescription_required': True},
+                [medicated_feed.template], {'prescription_required': False})
+            infos = Product.get_prescription_info([feed, medicated_feed])
+            self.assertTrue(infos[feed.id].required)
+            self.assertFalse(infos[medicated_feed.id].required)
@@ -0,0 +1,250 @@
+import datetime
+import unittest
+from decimal import Decimal
+from itertools import permutations
+
+from proteus import Model, Wizard
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.modules.farm_feed_production.feed_production import _carry_over
+from trytond.modules.farm_feed_production.tests.tools import (
+    add_prescription_lines, create_farm, create_supply_request,
+    server_transaction, setup_feed_production)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, drop_db
+from trytond.transaction import Transaction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Test(unittest.TestCase):
+    'Test the planning of the feed productions'
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+        self.data = setup_feed_production()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    @unittest.skipIf(backend.name == 'sqlite',
+        'confirm_by_warehouse requires concurrent connections')
+    def test_confirm_by_warehouse(self):
+        'Confirm the requests of each warehouse in parallel'
+        data = self.data
+        farm2, location, _, _ = create_farm(data.config, data.specie,
+            'Farm 2')
+        requests = [
+            create_supply_request(data,
+                [(data.medicated_feed, 100, data.location1)] * 3),
+            create_supply_request(data,
+                [(data.medicated_feed, 100, location)] * 3,
+                to_warehouse=farm2),
+            ]
+
+        with Transaction().start(DB_NAME, data.config.user,
+                context=data.config.context):
+            SupplyRequest = Pool().get('stock.supply_request')
+            failures = SupplyRequest.confirm_by_warehouse(
+                SupplyRequest.browse([r.id for r in requests]), workers=2)
+        self.assertEqual(failures, [])
+
+        Prescription = Model.get('farm.prescription')
+        for request in requests:
+            request.reload()
+            self.assertEqual(request.state, 'confirmed')
+        prescriptions = Prescription.find([])
+        self.assertEqual(len(prescriptions), 6)
+        self.assertEqual(len({p.rec_name for p in prescriptions}), 6)
+
+    def create_animals(self):
+        'Create three individuals in location 1 and a group of 4 in location 2'
+        data = self.data
+        Animal = Model.get('farm.animal')
+        AnimalGroup = Model.get('farm.animal.group')
+        today = datetime.date.today()
+        animals = []
+        for _ in range(3):
+            animal = Animal(type='individual', specie=data.specie,
+                breed=data.breed, arrival_date=today,
+                initial_location=data.location1)
+            animal.save()
+            animals.append(animal)
+        group = AnimalGroup(specie=data.specie, breed=data.breed,
+            arrival_date=today, initial_location=data.location2,
+            initial_quantity=4)
+        group.save()
+        return animals, group
+
+    @unittest.skipIf(numpy is None, 'numpy is required to forecast')
+    def test_forecast(self):
+        'Forecast the feed demand of the silo'
+        data = self.data
+        SupplyRequest = Model.get('stock.supply_request')
+        animals, group = self.create_animals()
+
+        forecast = Wizard('stock.supply_request.forecast')
+        forecast.form.silos.append(data.silo)
+        forecast.form.product = data.medicated_feed
+        forecast.form.consumption = 2
+        forecast.form.days = 10
+        forecast.execute('forecast')
+
+        request, = SupplyRequest.find([])
+        self.assertEqual(request.to_warehouse, data.farm)
+        line, = request.lines
+        self.assertEqual(line.to_location, data.silo)
+        self.assertEqual(line.quantity, 140)
+        self.assertEqual(line.unit, data.medicated_feed.default_uom)
+        self.assertTrue(line.from_forecast)
+
+        # Only the prescriptions of the forecast get the fed animals
+        hand = create_supply_request(data,
+            [(data.medicated_feed, 100, data.silo)])
+        self.assertFalse(hand.lines[0].from_forecast)
+        for supply_request in [request, hand]:
+            supply_request.click('confirm')
+        prescription = request.lines[0].move.prescription
+        self.assertEqual(set(prescription.animals), set(animals))
+        self.assertEqual(list(prescription.animal_groups), [group])
+        prescription = hand.lines[0].move.prescription
+        self.assertEqual(list(prescription.animals), [])
+        self.assertEqual(list(prescription.animal_groups), [])
+
+        # The silos must be inside a warehouse
+        Location = Model.get('stock.location')
+        silo = Location(name='Silo without warehouse', type='storage',
+            silo=True, locations_to_fed=[data.location1.id])
+        silo.save()
+        forecast = Wizard('stock.supply_request.forecast')
+        forecast.form.silos.extend([data.silo, silo])
+        forecast.form.product = data.medicated_feed
+        forecast.form.consumption = 2
+        forecast.form.days = 10
+        with self.assertRaises(UserError) as cm:
+            forecast.execute('forecast')
+        self.assertIn(silo.rec_name, cm.exception.message)
+        self.assertEqual(len(SupplyRequest.find([])), 2)
+
+    def test_merge_productions(self):
+        'Merge the compatible productions of the confirmed requests'
+        data = self.data
+        today = datetime.date.today()
+        request = create_supply_request(data, [
+                (data.feed, 100, data.location1),
+                (data.feed, 100, data.location2),
+                (data.feed, 100, data.location1),
+                (data.feed, 100, data.location2),
+                (data.medicated_feed, 100, data.location1),
+                ])
+        for line, days in zip(request.lines, [0, 0, 1, 5, 0]):
+            line.delivery_date = today + datetime.timedelta(days=days)
+        request.save()
+
+        with server_transaction(data.config):
+            pool = Pool()
+            SupplyRequest = pool.get('stock.supply_request')
+            Production = pool.get('production')
+            Move = pool.get('stock.move')
+
+            with Transaction().set_context(merge_productions=True,
+                    merge_window=2, mixer_capacity=250):
+                SupplyRequest.confirm([SupplyRequest(request.id)])
+
+            line1, line2, line3, line4, line5 = SupplyRequest(
+                request.id).lines
+            leader = line1.production
+            # The third line is within the window but over the capacity and
+            # the fourth is out of the window of the third
+            self.assertEqual(leader.quantity, 200)
+            self.assertEqual(line2.production, leader)
+            self.assertEqual(set(leader.merged_lines), {line1, line2})
+            for line in [line3, line4, line5]:
+                self.assertIsNone(line.merged_production)
+                self.assertNotEqual(line.production, leader)
+                self.assertEqual(line.production.quantity, 100)
+            productions = Production.search([])
+            self.assertEqual(len(productions), 4)
+            self.assertEqual({p.origin for p in productions},
+                {line1, line3, line4, line5})
+            Production.check_prescriptions(productions)
+
+            # The reservation of the merged line follows the one of the
+            # production
+            Production.draft([leader])
+            Production.wait([leader])
+            Production.assign([leader])
+            Production.run([leader])
+            Production.do([leader])
+            reservation = Move(line1.move.id)
+            merged_reservation = Move(line2.move.id)
+            self.assertEqual(merged_reservation.state, reservation.state)
+            self.assertEqual(merged_reservation.lot, reservation.lot)
+
+    def test_sequence_productions(self):
+        'Sequence the productions of a day to reduce the drugs carried over'
+        data = self.data
+        ProductTemplate = Model.get('product.template')
+        Product = Model.get('product.product')
+        drugs = [data.drug]
+        for name in ['Drug 2', 'Drug 3']:
+            template = ProductTemplate(name=name, default_uom=data.gr,
+                type='goods', prescription_required=True,
+                list_price=Decimal('1'), cost_price=Decimal('0.1'))
+            template.save()
+            drugs.append(Product(template=template))
+            drugs[-1].save()
+
+        request = create_supply_request(data, [
+                (data.feed, 100, data.location1),
+                (data.medicated_feed, 100, data.location1),
+                (data.medicated_feed, 100, data.location2),
+                (data.medicated_feed, 100, data.location1),
+                ])
+        request.click('confirm')
+        productions = [l.production for l in request.lines]
+        # The productions are sequenced on confirm
+        self.assertEqual(sorted(p.sequence for p in productions),
+            [1, 2, 3, 4])
+
+        drug_sets = [[], [drugs[0], drugs[1]], [drugs[1]],
+            [drugs[0], drugs[2]]]
+        for line, line_drugs in zip(request.lines[1:], drug_sets[1:]):
+            prescription = line.move.prescription
+            add_prescription_lines(prescription,
+                [(d, 10) for d in line_drugs])
+            prescription.save()
+        production = productions[0]
+        production.click('sequence_day')
+
+        for production in productions:
+            production.reload()
+        order = sorted(range(len(productions)),
+            key=lambda i: productions[i].sequence)
+        self.assertEqual([productions[i].sequence for i in order],
+            [1, 2, 3, 4])
+        drug_sets = [frozenset(d.id for d in s) for s in drug_sets]
+
+        def carry_over(order):
+            return sum(_carry_over(drug_sets[a], drug_sets[b])
+                for a, b in zip(order, order[1:]))
+        self.assertEqual(carry_over(order),
+            min(carry_over(o) for o in permutations(range(len(drug_sets)))))
+
+        # A new request sequences its productions after the ones of the day
+        # without changing them
+        sequences = [p.sequence for p in productions]
+        request = create_supply_request(data, [
+                (data.feed, 100, data.location2),
+                ])
+        request.click('confirm')
+        production, = [l.production for l in request.lines]
+        self.assertEqual(production.sequence, 5)
+        for production in productions:
+            production.reload()
+        self.assertEqual([p.sequence for p in productions], sequences)
@@ -0,0 +1,570 @@
+import datetime
+import io
+import json
+import unittest
+from datetime import timedelta
+from decimal import Decimal
+
+from proteus import Model
+
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model.exceptions import ValidationError
+from trytond.modules.farm_feed_production.feed_production import (
+    Prescription as FeedPrescription)
+from trytond.modules.farm_feed_production.tests.tools import (
+    add_prescription_lines, create_farm, create_prescription,
+    create_supply_request, server_transaction, setup_feed_production)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.transaction import Transaction
+
+
+class Test(unittest.TestCase):
+    'Test the prescriptions of the feed productions'
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+        self.data = setup_feed_production()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def confirm_request(self, lines):
+        'Create and confirm a supply request to the farm'
+        request = create_supply_request(self.data, lines)
+        request.click('confirm')
+        self.assertEqual(request.state, 'confirmed')
+        return request
+
+    def confirm_medicated_lines(self, drugs, quantities=(100,)):
+        '''
+        Confirm a supply request with a line of medicated feed for each
+        quantity and add the drugs to their prescriptions.
+        Returns the lines of the request.
+        '''
+        request = self.confirm_request([
+                (self.data.medicated_feed, q, self.data.location1)
+                for q in quantities])
+        for line in request.lines:
+            prescription = line.move.prescription
+            prescription.veterinarian = self.data.veterinarian
+            add_prescription_lines(prescription, drugs)
+            prescription.save()
+        return list(request.lines)
+
+    def confirm_medicated_line(self, drugs, quantity=100):
+        '''
+        Confirm a supply request of medicated feed, add the drugs to its
+        prescription and confirm it.
+        Returns the line of the request, its prescription and production.
+        '''
+        line, = self.confirm_medicated_lines(drugs, [quantity])
+        prescription = line.move.prescription
+        prescription.click('confirm')
+        self.assertEqual(prescription.state, 'confirmed')
+        production = line.production
+        production.reload()
+        return line, prescription, production
+
+    def test_check_prescriptions(self):
+        'Check the validation of the prescription input moves'
+        drug = self.data.drug
+        _, prescription, production = self.confirm_medicated_line(
+            [(drug, 100), (drug, 100)])
+        line1, line2 = prescription.lines
+        drug_inputs = [m for m in production.inputs if m.prescription]
+        self.assertEqual(len(drug_inputs), 2)
+        self.assertEqual({m.origin for m in drug_inputs}, {line1, line2})
+
+        # The input of a prescription line is missing
+        move = [m for m in production.inputs if m.origin == line2][0]
+        production.inputs.remove(move)
+        with self.assertRaises(ValidationError) as cm:
+            production.save()
+        self.assertIn(production.rec_name, cm.exception.message)
+        self.assertEqual(cm.exception.message.count(line2.rec_name), 1)
+        production.reload()
+
+        # A duplicated prescription line doesn't cover the other line
+        move = [m for m in production.inputs if m.origin == line2][0]
+        move.origin = line1
+        with self.assertRaises(ValidationError) as cm:
+            production.save()
+        self.assertIn(production.rec_name, cm.exception.message)
+        self.assertEqual(cm.exception.message.count(line2.rec_name), 1)
+        production.reload()
+
+        # An input of another prescription
+        other = create_prescription(self.data, drugs=[(drug, 100)])
+        move = [m for m in production.inputs if m.origin == line1][0]
+        move.prescription = other
+        with self.assertRaises(ValidationError) as cm:
+            production.save()
+        self.assertIn(production.rec_name, cm.exception.message)
+        self.assertIn(move.rec_name, cm.exception.message)
+        production.reload()
+
+        # The moves of all the lines are valid
+        production.save()
+
+    def test_do(self):
+        'Set the expiry date of the output lots and the prescription lots'
+        lines = self.confirm_medicated_lines([(self.data.drug, 100)],
+            [100, 200])
+        for line in lines:
+            prescription = line.move.prescription
+            prescription.expiry_period = 10
+            prescription.save()
+            prescription.click('confirm')
+        production_ids = [l.production.id for l in lines]
+
+        with server_transaction(self.data.config):
+            pool = Pool()
+            Production = pool.get('production')
+            Lot = pool.get('stock.lot')
+
+            productions = Production.browse(production_ids)
+            lots = []
+            for production in productions:
+                lot = Lot(number=production.rec_name,
+                    product=production.product)
+                lot.save()
+                lots.append(lot)
+                output, = [o for o in production.outputs
+                    if o.product == production.product]
+                output.lot = lot
+                output.save()
+            Production.draft([p for p in productions
+                    if p.state == 'request'])
+            Production.wait(productions)
+            Production.assign(productions)
+            Production.run(productions)
+            Production.do(productions)
+
+            for production, lot in zip(Production.browse(production_ids),
+                    lots):
+                self.assertEqual(production.state, 'done')
+                output, = [o for o in production.outputs
+                    if o.product == production.product]
+                self.assertEqual(Lot(lot.id).expiry_date,
+                    output.effective_date + timedelta(days=10))
+                self.assertEqual(production.prescription.lot, lot)
+                self.assertEqual(production.prescription.state, 'done')
+
+    def test_rescale_prescriptions(self):
+        'Rescale the prescriptions when the quantity of productions changes'
+        lines = self.confirm_medicated_lines(
+            [(self.data.drug, 100), (self.data.drug, 40)], [100, 100])
+        production_ids = [l.production.id for l in lines]
+
+        with server_transaction(self.data.config):
+            pool = Pool()
+            Production = pool.get('production')
+            Prescription = pool.get('farm.prescription')
+
+            productions = Production.browse(production_ids)
+            Production.explode_boms(productions)
+            production1, production2 = Production.browse(production_ids)
+            Production.write([production1], {'quantity': 200},
+                [production2], {'quantity': 50})
+
+            production1, production2 = Production.browse(production_ids)
+            self.assertEqual(production1.prescription.quantity, 200)
+            self.assertEqual([l.quantity
+                    for l in production1.prescription.lines], [200, 80])
+            self.assertEqual(production2.prescription.quantity, 50)
+            self.assertEqual([l.quantity
+                    for l in production2.prescription.lines], [50, 20])
+
+            # The quantity can not be changed once the prescription is
+            # confirmed
+            Prescription.confirm([production1.prescription])
+            with self.assertRaises(UserError) as cm:
+                Production.write([production1], {'quantity': 100})
+            self.assertEqual(cm.exception.message, gettext(
+                    'farm_feed_production.'
+                    'msg_no_changes_allowed_prescription_confirmed',
+                    production=production1.rec_name,
+                    prescription=production1.prescription.rec_name))
+
+    def test_assign_prescription_not_confirmed(self):
+        'Assign productions only with their prescriptions confirmed'
+        lines = self.confirm_medicated_lines([(self.data.drug, 100)],
+            [100, 100, 100])
+        production_ids = [l.production.id for l in lines]
+
+        with server_transaction(self.data.config):
+            pool = Pool()
+            Production = pool.get('production')
+            Prescription = pool.get('farm.prescription')
+
+            productions = Production.browse(production_ids)
+            Production.explode_boms(productions)
+            productions = Production.browse(production_ids)
+            Production.draft(productions)
+            Production.wait(productions)
+            production1, production2, production3 = productions
+            Prescription.confirm([production3.prescription])
+
+            with self.assertRaises(UserError) as cm:
+                Production.assign([production1, production3])
+            self.assertEqual(cm.exception.message, gettext(
+                    'farm_feed_production.msg_prescription_not_confirmed',
+                    prescription=production1.prescription.rec_name,
+                    production=production1.rec_name))
+
+            with self.assertRaises(UserError) as cm:
+                Production.assign(productions)
+            self.assertEqual(cm.exception.message, gettext(
+                    'farm_feed_production.msg_prescriptions_not_confirmed',
+                    productions=', '.join('%s (%s)' % (p.rec_name,
+                            p.prescription.rec_name)
+                        for p in [production1, production2])))
+
+            Production.assign([production3])
+            self.assertEqual(Production(production3.id).state, 'assigned')
+
+    def test_delete_prescriptions(self):
+        'Prescriptions related to productions can not be deleted'
+        lines = self.confirm_medicated_lines([(self.data.drug, 100)],
+            [100, 100])
+        prescription_ids = [l.move.prescription.id for l in lines]
+        other = create_prescription(self.data, drugs=[(self.data.drug, 10)])
+
+        with server_transaction(self.data.config):
+            pool = Pool()
+            Prescription = pool.get('farm.prescription')
+
+            prescription1, prescription2 = Prescription.browse(
+                prescription_ids)
+            with self.assertRaises(UserError) as cm:
+                Prescription.delete([prescription1])
+            self.assertEqual(cm.exception.message, gettext(
+                    'farm_feed_production.'
+                    'msg_cant_delete_productions_prescription',
+                    prescription=prescription1.rec_name,
+                    production=prescription1.origin_production.rec_name))
+
+            with self.assertRaises(UserError) as cm:
+                Prescription.delete([prescription1, prescription2,
+                        Prescription(other.id)])
+            self.assertEqual(cm.exception.message, gettext(
+                    'farm_feed_production.'
+                    'msg_cant_delete_productions_prescriptions',
+                    prescriptions=', '.join('%s (%s)' % (p.rec_name,
+                            p.origin_production.rec_name)
+                        for p in [prescription1, prescription2])))
+
+            Prescription.delete([Prescription(other.id)])
+            self.assertFalse(Prescription.search([('id', '=', other.id)]))
+
+    def test_origin_production(self):
+        'Store and fill the origin production of the prescriptions'
+        lines = self.confirm_medicated_lines([(self.data.drug, 100)],
+            [100, 100])
+        line_ids = [l.id for l in lines]
+        other = create_prescription(self.data, drugs=[(self.data.drug, 10)])
+
+        with server_transaction(self.data.config) as transaction:
+            pool = Pool()
+            Prescription = pool.get('farm.prescription')
+            SupplyRequestLine = pool.get('stock.supply_request.line')
+            cursor = transaction.connection.cursor()
+            table = Prescription.__table__()
+
+            lines = SupplyRequestLine.browse(line_ids)
+            for line in lines:
+                self.assertEqual(line.move.prescription.origin_production,
+                    line.production)
+            other = Prescription(other.id)
+            self.assertIsNone(other.origin_production)
+
+            # Sync when the origin changes
+            production = lines[0].production
+            Prescription.write([other], {'origin': str(production)})
+            self.assertEqual(Prescription(other.id).origin_production,
+                production)
+
+            # Fill the column as the migration does
+            expected = {
+                lines[0].move.prescription.id: lines[0].production.id,
+                lines[1].move.prescription.id: lines[1].production.id,
+                other.id: production.id,
+                }
+            cursor.execute(*table.update([table.origin_production], [None]))
+            Prescription._fill_origin_production()
+            cursor.execute(*table.select(table.id, table.origin_production))
+            self.assertEqual(dict(cursor), expected)
+
+            Prescription.write([other], {'origin': None})
+            self.assertIsNone(Prescription(other.id).origin_production)
+
+    def test_queue_prescriptions(self):
+        'Generate the prescriptions of the confirmed requests by the queue'
+        request = create_supply_request(self.data, [
+                (self.data.feed, 100, self.data.location1),
+                (self.data.medicated_feed, 100, self.data.location2),
+                ])
+
+        with server_transaction(self.data.config):
+            pool = Pool()
+            SupplyRequest = pool.get('stock.supply_request')
+            SupplyRequestLine = pool.get('stock.supply_request.line')
+            Production = pool.get('production')
+
+            request = SupplyRequest(request.id)
+            self.assertFalse(request.prescriptions_pending)
+            with Transaction().set_context(queue_prescriptions=True):
+                SupplyRequest.confirm([request])
+
+            # The tasks of the queue are not run before the commit
+            request = SupplyRequest(request.id)
+            self.assertEqual(request.state, 'confirmed')
+            self.assertTrue(request.prescriptions_pending)
+            feed_line, medicated_line = request.lines
+            self.assertFalse(feed_line.prescription_pending)
+            self.assertTrue(medicated_line.prescription_pending)
+            self.assertIsNone(medicated_line.production.prescription)
+            productions = [l.production for l in request.lines]
+            Production.check_prescriptions(productions)
+            with self.assertRaises(UserError) as cm:
+                Production.assign(productions)
+            self.assertEqual(cm.exception.message, gettext(
+                    'farm_feed_production.'
+                    'msg_production_prescription_pending',
+                    productions=medicated_line.production.rec_name))
+
+            SupplyRequestLine.generate_prescriptions(request.lines)
+            request = SupplyRequest(request.id)
+            self.assertFalse(request.prescriptions_pending)
+            _, medicated_line = request.lines
+            prescription = medicated_line.move.prescription
+            self.assertTrue(prescription)
+            self.assertEqual(medicated_line.production.prescription,
+                prescription)
+            self.assertEqual(prescription.origin_production,
+                medicated_line.production)
+            Production.check_prescriptions(
+                [l.production for l in request.lines])
+
+    def test_incremental_explode_bom(self):
+        'The incremental explosion gives the changes of a full explosion'
+        _, _, production = self.confirm_medicated_line(
+            [(self.data.drug, 100), (self.data.drug, 35)])
+
+        with server_transaction(self.data.config):
+            pool = Pool()
+            Production = pool.get('production')
+
+            stored = Production(production.id)
+            values = {n: getattr(stored, n).id for n in ['company',
+                    'warehouse', 'location', 'product', 'bom', 'unit',
+                    'prescription']}
+            values['planned_date'] = stored.planned_date
+            values['inputs'] = [m.id for m in stored.inputs]
+            values['outputs'] = [m.id for m in stored.outputs]
+
+            def explode_bom(quantity):
+                # A new record like the ones of the on_change calls
+                record = Production(stored.id, quantity=quantity, **values)
+                return record, record.explode_bom()
+
+            for quantity in [100, 37.3, 250, 0.7, 1234.56]:
+                with Transaction().set_context(explode_bom_incremental=True):
+                    record, incremental = explode_bom(quantity)
+                self.assertIsNotNone(Production._explode_bom_cache.get(
+                        record._explode_bom_key()))
+                _, full = explode_bom(quantity)
+                self.assertEqual(incremental, full)
+
+            # An explosion kept with a cost of 0 is scaled to the new costs
+            Product = pool.get('product.product')
+            components = Product.browse(
+                [p.id for p in self.data.feed_components + [self.data.drug]])
+            cost_prices = [p.cost_price for p in components]
+            Product.write(components, {'cost_price': Decimal(0)})
+            with Transaction().set_context(explode_bom_incremental=True):
+                _, incremental = explode_bom(100)
+            self.assertEqual({v['unit_price']
+                    for _, v in incremental['outputs']['add']}, {Decimal(0)})
+            for component, cost_price in zip(components, cost_prices):
+                Product.write([component], {'cost_price': cost_price})
+            with Transaction().set_context(explode_bom_incremental=True):
+                _, incremental = explode_bom(120)
+            _, full = explode_bom(120)
+            self.assertEqual(incremental, full)
+            self.assertTrue(all(v['unit_price']
+                    for _, v in full['outputs']['add']))
+
+    def test_explode_boms(self):
+        'The batch explosion gives the moves of each production explosion'
+        lines = self.confirm_medicated_lines([(self.data.drug, 100)],
+            [100, 250, 37.5])
+        production_ids = [l.production.id for l in lines]
+
+        with server_transaction(self.data.config):
+            pool = Pool()
+            Production = pool.get('production')
+
+            def moves(values):
+                return sorted((v['product'], v['quantity']) for v in values)
+
+            expected = []
+            for production in Production.browse(production_ids):
+                changes = production.explode_bom()
+                expected.append((
+                        moves(v for _, v in changes['inputs']['add']),
+                        moves(v for _, v in changes['outputs']['add'])))
+
+            Production.explode_boms(Production.browse(production_ids))
+            for production, (inputs, outputs) in zip(
+                    Production.browse(production_ids), expected):
+                self.assertEqual(moves({'product': m.product.id,
+                            'quantity': m.quantity}
+                        for m in production.inputs), inputs)
+                self.assertEqual(moves({'product': m.product.id,
+                            'quantity': m.quantity}
+                        for m in production.outputs), outputs)
+
+    def test_set_template(self):
+        'A batch of prescriptions gets the values of separate parent calls'
+        Template = Model.get('farm.prescription.template')
+        template = Template(specie=self.data.specie,
+            product=self.data.medicated_feed, quantity=100,
+            unit=self.data.kg)
+        for quantity in (120, 40):
+            line = template.lines.new()
+            line.product = self.data.drug
+            line.quantity = quantity
+        template.save()
+        prescription_ids = [create_prescription(self.data, quantity,
+                template=template).id for quantity in (100, 100, 250, 100)]
+
+        def applied(set_template):
+            with server_transaction(self.data.config):
+                pool = Pool()
+                Prescription = pool.get('farm.prescription')
+
+                Prescription._template_plan_cache.clear()
+                prescriptions = Prescription.browse(prescription_ids)
+                set_template(Prescription, prescriptions)
+                names = Prescription._stored_field_names(Prescription)
+                result = Prescription.read(prescription_ids, names)
+                for values, prescription in zip(result,
+                        Prescription.browse(prescription_ids)):
+                    values['lines'] = sorted((l.product.id, l.quantity,
+                            l.unit.id) for l in prescription.lines)
+                return result
+
+        def set_template_batch(Prescription, prescriptions):
+            # Twice so the second batch scales the plan of the first one
+            Prescription.set_template(prescriptions[:2])
+            Prescription.set_template(prescriptions[2:])
+
+        def set_template_parent(Prescription, prescriptions):
+            for prescription in prescriptions:
+                super(FeedPrescription, Prescription).set_template(
+                    [prescription])
+
+        batch = applied(set_template_batch)
+        self.assertTrue(all(v['lines'] for v in batch))
+        self.assertEqual(batch, applied(set_template_parent))
+
+    def test_traceability(self):
+        'Export the traceability of the prescriptions with the filters'
+        data = self.data
+        farm2, _, _, _ = create_farm(data.config, data.specie, 'Farm 2')
+        ProductTemplate = Model.get('product.template')
+        Product = Model.get('product.product')
+        template = ProductTemplate(name='Drug 2', default_uom=data.gr,
+            type='goods', prescription_required=True,
+            list_price=Decimal('1'), cost_price=Decimal('0.1'))
+        template.save()
+        drug2 = Product(template=template)
+        drug2.save()
+
+        today = datetime.date.today()
+        yesterday = today - timedelta(days=1)
+        Prescription = Model.get('farm.prescription')
+        prescriptions = []
+        for farm, date, drugs in [
+                (data.farm, today, [(data.drug, 100), (drug2, 50)]),
+                (farm2, today, [(data.drug, 30)]),
+                (data.farm, yesterday, [(drug2, 20)]),
+                ]:
+            prescription = Prescription(specie=data.specie, farm=farm,
+                date=date, delivery_date=date, product=data.medicated_feed,
+                quantity=100, veterinarian=data.veterinarian)
+            add_prescription_lines(prescription, drugs)
+            prescription.save()
+            prescriptions.append(prescription)
+
+        def expected(*prescription_lines):
+            return [{
+                    'prescription': prescriptions[p].rec_name,
+                    'date': prescriptions[p].date,
+                    'farm': prescriptions[p].farm.rec_name,
+                    'feed': data.medicated_feed.rec_name,
+                    'feed_lot': None,
+                    'quantity': 100.0,
+                    'unit': prescriptions[p].unit.rec_name,
+                    'production': None,
+                    'supply_request': None,
+                    'drug': prescriptions[p].lines[l].product.rec_name,
+                    'drug_quantity': prescriptions[p].lines[l].quantity,
+                    'drug_unit': prescriptions[p].lines[l].unit.rec_name,
+                    'drug_lots': '',
+                    } for p, l in prescription_lines]
+
+        with server_transaction(data.config):
+            pool = Pool()
+            Prescription = pool.get('farm.prescription')
+
+            def traceability(**filters):
+                return list(Prescription.traceability(**filters))
+
+            # Chunks smaller, equal and bigger than the prescriptions
+            for chunk_size in [1, 2, 3, 100]:
+                self.assertEqual(traceability(chunk_size=chunk_size),
+                    expected((0, 0), (0, 1), (1, 0), (2, 0)))
+            self.assertEqual(traceability(farms=[farm2.id], chunk_size=1),
+                expected((1, 0)))
+            self.assertEqual(traceability(start_date=today, chunk_size=1),
+                expected((0, 0), (0, 1), (1, 0)))
+            self.assertEqual(traceability(end_date=yesterday),
+                expected((2, 0)))
+            self.assertEqual(traceability(drugs=[drug2.id], chunk_size=1),
+                expected((0, 1), (2, 0)))
+            self.assertEqual(traceability(farms=[data.farm.id],
+                    drugs=[data.drug.id], start_date=today), expected((0, 0)))
+
+            file = io.StringIO()
+            self.assertEqual(Prescription.export_traceability(file,
+                    drugs=[drug2.id], chunk_size=1), 2)
+            rows = [[row['prescription'], str(row['date']), row['farm'],
+                    row['feed'], '', '100.0', row['unit'], '', '',
+                    row['drug'], str(row['drug_quantity']), row['drug_unit'],
+                    ''] for row in expected((0, 1), (2, 0))]
+            self.assertEqual(file.getvalue(), ''.join(','.join(r) + '\r\n'
+                    for r in [['prescription', 'date', 'farm', 'feed',
+                            'feed_lot', 'quantity', 'unit', 'production',
+                            'supply_request', 'drug', 'drug_quantity',
+                            'drug_unit', 'drug_lots']] + rows))
+
+            file = io.StringIO()
+            self.assertEqual(Prescription.export_traceability(file,
+                    format='jsonl', farms=[farm2.id]), 1)
+            row, = expected((1, 0))
+            self.assertEqual(file.getvalue().splitlines(), [
+                    '{"prescription": %s, "date": "%s", "farm": %s, '
+                    '"feed": %s, "feed_lot": null, "quantity": 100.0, '
+                    '"unit": %s, "production": null, "supply_request": null, '
+                    '"drug": %s, "drug_quantity": %s, "drug_unit": %s, '
+                    '"drug_lots": ""}' % (json.dumps(row['prescription']),
+                        row['date'], json.dumps(row['farm']),
+                        json.dumps(row['feed']), json.dumps(row['unit']),
+                        json.dumps(row['drug']), row['drug_quantity'],
+                        json.dumps(row['drug_unit']))])
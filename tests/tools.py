@@ -0,0 +1,244 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+from contextlib import contextmanager
+from decimal import Decimal
+from types import SimpleNamespace
+
+from proteus import Model
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.tests.test_tryton import DB_NAME
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+def setup_feed_production():
+    '''
+    Activate the module and create the data shared by the scenarios: a
+    company, a farm with a silo which feeds two locations, the pig specie, a
+    feed and a medicated feed with their BOM, a drug, a veterinarian and the
+    stock of the feed components and the drug.
+    Returns a SimpleNamespace with the created records.
+    '''
+    config = activate_modules('farm_feed_production')
+    _ = create_company()
+    company = get_company()
+    User = Model.get('res.user')
+    config._context = User.get_preferences(True, config.context)
+
+    Location = Model.get('stock.location')
+    warehouse, = Location.find([('code', '=', 'WH')])
+    production_location, = Location.find([('code', '=', 'PROD')])
+    warehouse.production_location = production_location
+    warehouse.save()
+    lost_found_location, = Location.find([('type', '=', 'lost_found')])
+
+    StockConfiguration = Model.get('stock.configuration')
+    Sequence = Model.get('ir.sequence')
+    SequenceType = Model.get('ir.sequence.type')
+    StrictSequence = Model.get('ir.sequence.strict')
+    stock_configuration = StockConfiguration(1)
+    request_sequence, = Sequence.find([
+            ('sequence_type.name', '=', 'Supply Request'),
+            ])
+    stock_configuration.supply_request_sequence = request_sequence
+    stock_configuration.request_from_warehouse = warehouse
+    stock_configuration.save()
+
+    ProductUom = Model.get('product.uom')
+    unit, = ProductUom.find([('name', '=', 'Unit')])
+    kg, = ProductUom.find([('name', '=', 'Kilogram')])
+    gr, = ProductUom.find([('name', '=', 'Gram')])
+    ProductTemplate = Model.get('product.template')
+    Product = Model.get('product.product')
+
+    def create_product(name, uom, cost_price, **values):
+        template = ProductTemplate(name=name, default_uom=uom, type='goods',
+            list_price=cost_price * 2, cost_price=cost_price, **values)
+        template.save()
+        product = Product(template=template)
+        product.save()
+        return product
+
+    individual_product = create_product('Male Pig', unit, Decimal('25'))
+    group_product = create_product('Group of Pig', unit, Decimal('20'))
+    feed_component1 = create_product('Pig Feed Component 1', kg,
+        Decimal('20'))
+    feed_component2 = create_product('Pig Feed Component 2', kg,
+        Decimal('30'))
+    drug = create_product('Drug additive', gr, Decimal('0.1'),
+        prescription_required=True)
+    feed = create_product('Pig Feed', kg, Decimal('25'), producible=True)
+    medicated_feed = create_product('Medicated Pig Feed', kg, Decimal('30'),
+        producible=True, prescription_required=True)
+
+    BOM = Model.get('production.bom')
+    BOMInput = Model.get('production.bom.input')
+    BOMOutput = Model.get('production.bom.output')
+    ProductBom = Model.get('product.product-production.bom')
+    boms = []
+    for product in (feed, medicated_feed):
+        bom = BOM(name=product.rec_name)
+        bom.inputs.append(BOMInput(product=feed_component1, quantity=0.85))
+        bom.inputs.append(BOMInput(product=feed_component2, quantity=150,
+                unit=gr))
+        bom.outputs.append(BOMOutput(product=product, quantity=1))
+        bom.save()
+        product.boms.append(ProductBom(bom=bom))
+        product.save()
+        boms.append(bom)
+
+    sequence_type, = SequenceType.find([('name', '=', 'Prescription')])
+    prescription_sequence = StrictSequence(name='Pig Prescriptions',
+        sequence_type=sequence_type, padding=4)
+    prescription_sequence.save()
+
+    Specie = Model.get('farm.specie')
+    SpecieBreed = Model.get('farm.specie.breed')
+    specie = Specie(name='Pigs', male_enabled=False, female_enabled=False,
+        individual_enabled=True, individual_product=individual_product,
+        group_enabled=True, group_product=group_product,
+        prescription_enabled=True,
+        prescription_sequence=prescription_sequence,
+        removed_location=lost_found_location,
+        foster_location=lost_found_location,
+        lost_found_location=lost_found_location,
+        feed_lost_found_location=lost_found_location)
+    specie.save()
+    breed = SpecieBreed(specie=specie, name='Holland')
+    breed.save()
+    farm, location1, location2, silo = create_farm(config, specie, 'Farm')
+
+    Party = Model.get('party.party')
+    veterinarian = Party(name='Veterinarian', veterinarian=True,
+        collegiate_number='123456789')
+    veterinarian.save()
+
+    Inventory = Model.get('stock.inventory')
+    inventory = Inventory(location=warehouse.storage_location)
+    for product, quantity in ((feed_component1, 3000),
+            (feed_component2, 500), (drug, 10000)):
+        inventory_line = inventory.lines.new()
+        inventory_line.product = product
+        inventory_line.quantity = quantity
+    inventory.save()
+    Inventory.confirm([inventory.id], config.context)
+
+    return SimpleNamespace(config=config, company=company,
+        warehouse=warehouse, farm=farm, location1=location1,
+        location2=location2, silo=silo, specie=specie, breed=breed,
+        unit=unit, kg=kg, gr=gr, feed=feed, medicated_feed=medicated_feed,
+        feed_bom=boms[0], medicated_feed_bom=boms[1],
+        feed_components=[feed_component1, feed_component2], drug=drug,
+        veterinarian=veterinarian)
+
+
+def create_farm(config, specie, name):
+    '''
+    Create a farm warehouse for the specie with two locations and a silo
+    which feeds them.
+    Returns the farm, the two locations and the silo.
+    '''
+    Location = Model.get('stock.location')
+    Sequence = Model.get('ir.sequence')
+    SequenceType = Model.get('ir.sequence.type')
+    SpecieFarmLine = Model.get('farm.specie.farm_line')
+
+    def create_sequence(type_name, sequence_name):
+        sequence_type, = SequenceType.find([('name', '=', type_name)])
+        sequence = Sequence(name=sequence_name, sequence_type=sequence_type,
+            padding=4)
+        sequence.save()
+        return sequence
+
+    storage_id, input_id, production_id = Location.create([{
+                'name': '%s Storage' % name,
+                'type': 'storage',
+                }, {
+                'name': '%s Input' % name,
+                'type': 'storage',
+                }, {
+                'name': '%s Production' % name,
+                'type': 'production',
+                }], config.context)
+    farm = Location(name=name, type='warehouse', storage_location=storage_id,
+        input_location=input_id, output_location=storage_id,
+        production_location=production_id)
+    farm.save()
+    location1_id, location2_id = Location.create([{
+                'name': '%s Location 1' % name,
+                'type': 'storage',
+                'parent': storage_id,
+                }, {
+                'name': '%s Location 2' % name,
+                'type': 'storage',
+                'parent': storage_id,
+                }], config.context)
+    silo = Location(name='%s Silo' % name, type='storage',
+        parent=farm.storage_location, silo=True,
+        locations_to_fed=[location1_id, location2_id])
+    silo.save()
+    SpecieFarmLine(specie=specie, farm=farm,
+        event_order_sequence=create_sequence('Event Order',
+            'Event Order %s' % name),
+        has_individual=True,
+        individual_sequence=create_sequence('Animal',
+            'Individuals %s' % name),
+        has_group=True,
+        group_sequence=create_sequence('Animal Group',
+            'Groups %s' % name)).save()
+    return farm, Location(location1_id), Location(location2_id), silo
+
+
+def create_supply_request(data, lines, to_warehouse=None):
+    '''
+    Create a supply request from the warehouse to the farm (or to_warehouse)
+    with a line for each (product, quantity, to_location) of lines.
+    '''
+    SupplyRequest = Model.get('stock.supply_request')
+    request = SupplyRequest(company=data.company,
+        from_warehouse=data.warehouse,
+        to_warehouse=to_warehouse or data.farm, lines=[])
+    for product, quantity, to_location in lines:
+        line = request.lines.new()
+        line.product = product
+        line.quantity = quantity
+        line.to_location = to_location
+    request.save()
+    return request
+
+
+def create_prescription(data, quantity=100, drugs=None, **values):
+    '''
+    Create a draft prescription of the medicated feed for the farm with a
+    line for each (drug, quantity) of drugs.
+    '''
+    Prescription = Model.get('farm.prescription')
+    prescription = Prescription(specie=data.specie, farm=data.farm,
+        delivery_date=datetime.date.today(), product=data.medicated_feed,
+        quantity=quantity, veterinarian=data.veterinarian, **values)
+    add_prescription_lines(prescription, drugs or [])
+    prescription.save()
+    return prescription
+
+
+def add_prescription_lines(prescription, drugs):
+    'Add a line to the prescription for each (drug, quantity) of drugs'
+    for drug, quantity in drugs:
+        line = prescription.lines.new()
+        line.product = drug
+        line.quantity = quantity
+
+
+@contextmanager
+def server_transaction(config):
+    '''
+    Start a server side transaction with the user and context of the proteus
+    configuration which is rolled back at the end.
+    '''
+    with Transaction().start(DB_NAME, config.user,
+            context=config.context) as transaction:
+        try:
+            yield transaction
+        finally:
+            transaction.rollback()
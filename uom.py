@@ -0,0 +1,107 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import namedtuple
+
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['Uom']
+
+UomConversion = namedtuple('UomConversion',
+    ['category', 'accurate_field', 'factor', 'rate'])
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+    _conversion_table_cache = Cache('product.uom.get_conversion_table',
+        context=False)
+
+    @classmethod
+    def get_conversion_table(cls, uoms):
+        '''
+        Returns a dictionary with the UomConversion of all the units of the
+        categories of uoms keyed by unit id.
+        The units not in the cache are loaded with one search and one read
+        for all their categories.
+        '''
+        table = {}
+        missing = set()
+        for uom in uoms:
+            uom_id = int(uom)
+            conversion = cls._conversion_table_cache.get(uom_id)
+            if conversion is None:
+                missing.add(uom_id)
+            else:
+                table[uom_id] = UomConversion(*conversion)
+        if missing:
+            with Transaction().set_context(active_test=False):
+                categories = {v['category']
+                    for v in cls.read(list(missing), ['category'])}
+                category_uoms = cls.search([
+                        ('category', 'in', list(categories)),
+                        ])
+            for values in cls.read([u.id for u in category_uoms],
+                    ['category', 'accurate_field', 'factor', 'rate']):
+                conversion = (values['category'], values['accurate_field'],
+                    values['factor'], values['rate'])
+                cls._conversion_table_cache.set(values['id'], conversion)
+                table[values['id']] = UomConversion(*conversion)
+        return table
+
+    @classmethod
+    def convert_qty(cls, from_uom, qty, to_uom, round=True):
+        '''
+        Convert quantity like compute_qty but using the conversion table,
+        so no unit is read once the table is loaded.
+        The rounded quantities are the ones of compute_qty but without
+        rounding they may differ in the last digits of the float precision.
+        '''
+        if not qty or (from_uom is None and to_uom is None):
+            return qty
+        if from_uom is None or to_uom is None:
+            # Raise the same error than compute_qty
+            return cls.compute_qty(from_uom, qty, to_uom, round=round)
+        if from_uom != to_uom:
+            table = cls.get_conversion_table([from_uom, to_uom])
+            from_ = table[from_uom.id]
+            to = table[to_uom.id]
+            if from_.category != to.category:
+                # Raise the same error than compute_qty
+                return cls.compute_qty(from_uom, qty, to_uom, round=round)
+            if from_.accurate_field == 'factor':
+                amount = qty * from_.factor
+            else:
+                amount = qty / from_.rate
+            if to.accurate_field == 'factor':
+                amount = amount / to.factor
+            else:
+                amount = amount * to.rate
+        else:
+            amount = qty
+        if round:
+            amount = to_uom.round(amount)
+        return amount
+
+    @classmethod
+    def _clear_cache(cls):
+        pool = Pool()
+        Production = pool.get('production')
+        cls._conversion_table_cache.clear()
+        Production._explode_bom_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        uoms = super(Uom, cls).create(vlist)
+        cls._clear_cache()
+        return uoms
+
+    @classmethod
+    def write(cls, *args):
+        super(Uom, cls).write(*args)
+        cls._clear_cache()
+
+    @classmethod
+    def delete(cls, uoms):
+        super(Uom, cls).delete(uoms)
+        cls._clear_cache()